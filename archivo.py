@@ -0,0 +1,213 @@
+"""Archivo comprimido de las paginas descargadas (listados y detalles) y reparseo offline.
+
+Cada pagina se guarda como un miembro gzip anadido al fichero del dia (paginas_AAAAMMDD.gz) y se indexa en
+indice.db por url y momento de descarga, con su posicion dentro del fichero.
+
+    python archivo.py resumen
+    python archivo.py reparsear --tipo listado --desde 2022-03-01 --procesos 4 --historial
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from multiprocessing import Pool
+
+from metricas import medir, incrementar
+
+logger = logging.getLogger(__name__)
+
+# carpeta del archivo; si no se define no se archiva nada
+ARCHIVO_DIR = os.environ.get('ARCHIVO_DIR')
+NIVEL = int(os.environ.get('ARCHIVO_NIVEL', 6))
+
+_lock = threading.Lock()
+_conexion = []
+
+
+def _indice(directorio):
+    os.makedirs(directorio, exist_ok=True)
+    conexion = sqlite3.connect(os.path.join(directorio, 'indice.db'), check_same_thread=False)
+    conexion.execute(
+        "CREATE TABLE IF NOT EXISTS paginas(id integer PRIMARY KEY, url text, tipo text, obtenido real, "
+        "departamento text, palabra_clave text, fichero text, desplazamiento integer, longitud integer, sha1 text)")
+    conexion.execute("CREATE INDEX IF NOT EXISTS idx_paginas_url ON paginas(url, obtenido)")
+    conexion.execute("CREATE INDEX IF NOT EXISTS idx_paginas_obtenido ON paginas(obtenido)")
+    conexion.commit()
+    return conexion
+
+
+def guardar(url, tipo, source, departamento=None, palabra_clave=None):
+    """Archiva una pagina ('listado' o 'detalle') salvo que sea igual a la ultima version de la misma url"""
+    if not ARCHIVO_DIR:
+        return
+    try:
+        with medir('archivo'), _lock:
+            if not _conexion:
+                _conexion.append(_indice(ARCHIVO_DIR))
+            conexion = _conexion[0]
+            datos = source.encode('utf-8')
+            sha1 = hashlib.sha1(datos).hexdigest()
+            ultima = conexion.execute("SELECT sha1 from paginas where url = ? ORDER BY obtenido DESC LIMIT 1",
+                                      (url,)).fetchone()
+            if ultima and ultima[0] == sha1:
+                incrementar('paginas_repetidas', etiqueta=tipo, nombre_etiqueta='tipo')
+                return
+            ahora = time.time()
+            fichero = 'paginas_' + datetime.fromtimestamp(ahora, timezone.utc).strftime('%Y%m%d') + '.gz'
+            comprimido = gzip.compress(datos, NIVEL)
+            with open(os.path.join(ARCHIVO_DIR, fichero), 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                desplazamiento = f.tell()
+                f.write(comprimido)
+            conexion.execute(
+                "INSERT INTO paginas(url, tipo, obtenido, departamento, palabra_clave, fichero, desplazamiento, "
+                "longitud, sha1) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, tipo, ahora, departamento, palabra_clave, fichero, desplazamiento, len(comprimido), sha1))
+            conexion.commit()
+        incrementar('paginas_archivadas', etiqueta=tipo, nombre_etiqueta='tipo')
+    except Exception as e:
+        logger.exception(e)
+
+
+def leer(directorio, fichero, desplazamiento, longitud):
+    with open(os.path.join(directorio, fichero), 'rb') as f:
+        f.seek(desplazamiento)
+        return gzip.decompress(f.read(longitud)).decode('utf-8')
+
+
+def recorrer(directorio, tipo=None, desde=None, hasta=None):
+    """Filas del indice en orden de descarga, sacadas del cursor de una en una"""
+    consulta = ("SELECT id, url, tipo, obtenido, departamento, palabra_clave, fichero, desplazamiento, longitud "
+                "from paginas where 1 = 1")
+    parametros = []
+    if tipo:
+        consulta += " and tipo = ?"
+        parametros.append(tipo)
+    if desde:
+        consulta += " and obtenido >= ?"
+        parametros.append(desde)
+    if hasta:
+        consulta += " and obtenido < ?"
+        parametros.append(hasta)
+    conexion = sqlite3.connect(os.path.join(directorio, 'indice.db'))
+    try:
+        for fila in conexion.execute(consulta + " ORDER BY obtenido", parametros):
+            yield fila
+    finally:
+        conexion.close()
+
+
+def _reparsear(tarea):
+    """En un proceso del pool: lee una pagina del archivo y le pasa el extractor de su tipo"""
+    # scraper importa este modulo: se importa aqui para no hacer un ciclo
+    from scraper import extraer_anuncios, extraer_contacto, extraer_imagen
+    directorio, fila = tarea
+    tipo, palabra_clave = fila[2], fila[5]
+    try:
+        source = leer(directorio, fila[6], fila[7], fila[8])
+        if tipo == 'listado':
+            return fila, extraer_anuncios(source, palabra_clave or ''), None
+        contacto, telefono, email = extraer_contacto(source)
+        return fila, {'contacto': contacto, 'telefono': telefono, 'email': email,
+                      'imagen': extraer_imagen(source)}, None
+    except Exception as e:
+        return fila, None, repr(e)
+
+
+def reparsear(directorio, tipo=None, desde=None, hasta=None, procesos=None, historial=False, salida=None):
+    """Vuelve a extraer los anuncios de todas las paginas archivadas; devuelve un resumen"""
+    if historial:
+        from db import archivar_anuncios, crear_tablas_historial
+        crear_tablas_historial()
+    resumen = {'paginas': 0, 'listados': 0, 'detalles': 0, 'sin_lista': 0, 'anuncios': 0, 'con_fecha': 0,
+               'con_precio': 0, 'con_contacto': 0, 'errores': 0, 'nuevos_historial': 0}
+    inicio = time.perf_counter()
+    fichero_salida = open(salida, 'w', encoding='utf-8') if salida else None
+    tareas = ((directorio, fila) for fila in recorrer(directorio, tipo, desde, hasta))
+    try:
+        with Pool(procesos) as pool:
+            for fila, resultado, error in pool.imap(_reparsear, tareas, chunksize=16):
+                resumen['paginas'] += 1
+                if error is not None:
+                    resumen['errores'] += 1
+                    logger.warning('No se pudo reparsear', extra={'datos': {'url': fila[1], 'error': error}})
+                    continue
+                if fila[2] == 'listado':
+                    resumen['listados'] += 1
+                    if resultado is None:
+                        resumen['sin_lista'] += 1
+                        continue
+                    anuncios = [anuncio for anuncio in resultado if anuncio['url'] != 'no tiene']
+                    resumen['anuncios'] += len(anuncios)
+                    # si revolico cambia los nombres de clase estos contadores caen a cero
+                    resumen['con_fecha'] += sum(1 for anuncio in anuncios if anuncio['fecha'] != 'no tiene')
+                    resumen['con_precio'] += sum(1 for anuncio in anuncios if anuncio['precio'] != 'no tiene')
+                    if historial:
+                        resumen['nuevos_historial'] += archivar_anuncios(fila[4], fila[5], anuncios, visto=fila[3])
+                    registros = [dict(anuncio, pagina=fila[1], obtenido=fila[3]) for anuncio in anuncios]
+                else:
+                    resumen['detalles'] += 1
+                    if resultado['contacto'] != 'no tiene':
+                        resumen['con_contacto'] += 1
+                    registros = [dict(resultado, url=fila[1], obtenido=fila[3])]
+                if fichero_salida:
+                    for registro in registros:
+                        fichero_salida.write(json.dumps(registro, ensure_ascii=False) + "\n")
+    finally:
+        if fichero_salida:
+            fichero_salida.close()
+    segundos = time.perf_counter() - inicio
+    resumen['segundos'] = round(segundos, 2)
+    resumen['paginas_por_segundo'] = round(resumen['paginas'] / segundos, 1) if segundos else 0
+    return resumen
+
+
+def resumen_archivo(directorio):
+    conexion = sqlite3.connect(os.path.join(directorio, 'indice.db'))
+    filas = conexion.execute(
+        "SELECT tipo, count(*), sum(longitud), min(obtenido), max(obtenido) from paginas GROUP BY tipo").fetchall()
+    conexion.close()
+    return {tipo: {'paginas': cantidad, 'bytes_comprimidos': total,
+                   'desde': datetime.fromtimestamp(primera, timezone.utc).isoformat(),
+                   'hasta': datetime.fromtimestamp(ultima, timezone.utc).isoformat()}
+            for tipo, cantidad, total, primera, ultima in filas}
+
+
+def _fecha(texto):
+    return datetime.strptime(texto, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp() if texto else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archivo de paginas descargadas de revolico')
+    parser.add_argument('orden', choices=['resumen', 'reparsear'])
+    parser.add_argument('--dir', default=ARCHIVO_DIR or 'archivo', help='carpeta del archivo (por defecto ARCHIVO_DIR)')
+    parser.add_argument('--tipo', choices=['listado', 'detalle'], help='solo paginas de este tipo')
+    parser.add_argument('--desde', help='solo paginas descargadas desde esta fecha (AAAA-MM-DD, UTC)')
+    parser.add_argument('--hasta', help='solo paginas descargadas antes de esta fecha (AAAA-MM-DD, UTC)')
+    parser.add_argument('--procesos', type=int, help='procesos del pool (por defecto uno por cpu)')
+    parser.add_argument('--historial', action='store_true', help='guardar los anuncios recuperados en el historial')
+    parser.add_argument('--salida', help='fichero jsonl con todo lo extraido')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    if not os.path.exists(os.path.join(args.dir, 'indice.db')):
+        print('No hay archivo en ' + args.dir)
+        return 1
+    if args.orden == 'resumen':
+        resultado = resumen_archivo(args.dir)
+    else:
+        resultado = reparsear(args.dir, args.tipo, _fecha(args.desde), _fecha(args.hasta), args.procesos,
+                              args.historial, args.salida)
+    print(json.dumps(resultado, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,575 @@
+"""Benchmark offline del bot: revolico falso + API de telegram falsa.
+
+Ejemplo:
+    python benchmark.py --anuncios 40 --ciclos 5 --latencia 50 --salida bench.json
+    python benchmark.py --salida bench_nuevo.json --comparar bench.json
+    python benchmark.py --modo-bot polling --updates grabados.json --salida polling.json
+    python benchmark.py --solo-comandos --modo-bot webhook
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+PALABRAS = ['telefono', 'laptop', 'nevera', 'split', 'moto', 'bicicleta', 'televisor', 'casa', 'lavadora', 'ventilador']
+LUGARES = ['Plaza, La Habana', 'Playa, La Habana', 'Centro Habana, La Habana', 'Cerro, La Habana', 'Boyeros, La Habana']
+TOKEN_FALSO = '123456:BENCHMARK'
+CHAT_FALSO = 1122914981
+
+
+# ---->revolico falso
+
+def pagina_listado(departamento, consulta, parametros):
+    azar = random.Random(zlib.crc32((departamento + consulta).encode()))
+    anuncios = []
+    for i in range(parametros['anuncios']):
+        id = 1000000 + i
+        coincide = azar.random() < parametros['coincidencias']
+        palabra = consulta if coincide else azar.choice(PALABRAS)
+        titulo = palabra.capitalize() + " " + str(id)
+        descripcion = (palabra + " en buen estado ") * max(1, parametros['tamano'] // 25)
+        if i < parametros['nuevos']:
+            momento = "hace " + str(azar.randint(1, 59)) + " segundos"
+        else:
+            momento = "hace " + str(azar.randint(2, 59)) + " minutos"
+        foto = ('<a class="List__StyledTooltip-sc-1oa0tfl-11 ADRO">' + str(azar.randint(1, 5)) + ' fotos</a>'
+                if azar.random() < parametros['fotos'] else '')
+        anuncios.append(
+            '<li><a href="/' + departamento + '/' + palabra + '-' + str(id) + '.html">'
+            '<span data-cy="adTitle">' + titulo + '</span>'
+            '<span data-cy="adPrice">' + str(azar.randint(10, 2000)) + ' USD</span>'
+            '<span class="List__Description-sc-1oa0tfl-3 ljbzeb">' + descripcion + '</span>'
+            '<time class="List__AdMoment-sc-1oa0tfl-8 eWSYKR">' + momento + '</time>'
+            '<span class="List__Location-sc-1oa0tfl-10 IKJXO">' + azar.choice(LUGARES) + '</span>'
+            '</a>' + foto + '</li>'
+        )
+    # la estructura del formulario respeta los xpath que usa scraper.obeteniendo_html
+    return (
+        '<html><head><title>Revolico</title></head><body><div><div><main><div><div>'
+        '<div><h1>' + departamento + '</h1></div>'
+        '<div><form method="get" action="/' + departamento + '/search.html"><div>'
+        '<div><div>Precio</div><div><input name="min_price"><input name="max_price"></div></div>'
+        '<div><div><div><div><select name="province"><option></option><option>La Habana</option>'
+        '<option>Matanzas</option></select></div></div></div></div>'
+        '<div><button type="submit">Buscar</button></div>'
+        '</div><input type="hidden" name="q" value="' + consulta + '"></form></div>'
+        '<div><ul>' + "".join(anuncios) + '</ul></div>'
+        '</div></div></main></div></div></body></html>'
+    )
+
+
+def pagina_detalle(ruta, parametros):
+    id = ruta.rsplit('-', 1)[-1].split('.')[0]
+    # como en revolico, las imagenes llevan url absoluta (en produccion, de su cdn)
+    imagenes = "".join('<div><a href="' + parametros.get('base', '') + '/img/' + id + '-' + str(n) + '.jpg">foto</a></div>' for n in range(3))
+    return (
+        '<html><head><title>Anuncio</title></head><body><div><main>'
+        '<h1>Anuncio ' + id + '</h1><p>' + ('detalle ' * max(1, parametros['tamano'] // 8)) + '</p>'
+        '<div class="Detail__ImagesWrapper-sc-1irc1un-8 hImDlm">' + imagenes + '</div>'
+        '<div data-cy="adName">Vendedor ' + id + '</div>'
+        '<a data-cy="adPhone">5' + id[-7:] + '</a>'
+        '<a data-cy="adEmail">vendedor' + id + '@correo.cu</a>'
+        '</main></div></body></html>'
+    )
+
+
+class ManejadorRevolico(BaseHTTPRequestHandler):
+    parametros = {}
+    peticiones = {'listado': 0, 'detalle': 0, 'imagen': 0}
+
+    def do_GET(self):
+        time.sleep(self.parametros['latencia'])
+        ruta = urlparse(self.path)
+        if ruta.path.startswith('/img/'):
+            self.peticiones['imagen'] += 1
+            self.responder(b'\xff\xd8\xff\xe0' + b'\x00' * 2048, 'image/jpeg')
+        elif ruta.path.endswith('/search.html'):
+            self.peticiones['listado'] += 1
+            consulta = parse_qs(ruta.query).get('q', [''])[0]
+            departamento = ruta.path.strip('/').split('/')[0]
+            self.responder(pagina_listado(departamento, consulta, self.parametros).encode())
+        elif ruta.path.endswith('.html'):
+            self.peticiones['detalle'] += 1
+            # una parte de las paginas de anuncio se cuelga (ver --lentos)
+            if random.random() < self.parametros['lentos']:
+                self.peticiones['detalle_lento'] = self.peticiones.get('detalle_lento', 0) + 1
+                time.sleep(self.parametros['lentitud'])
+            self.responder(pagina_detalle(ruta.path, self.parametros).encode())
+        else:
+            self.send_error(404)
+
+    def responder(self, cuerpo, tipo='text/html; charset=utf-8'):
+        self.send_response(200)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+# ---->proxies locales
+
+class ManejadorProxy(BaseHTTPRequestHandler):
+    """Proxy http de reenvio (GET con url absoluta); los `rotos` responden 502 a todo"""
+    rotos = set()
+    peticiones = {}
+    _directo = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    def do_GET(self):
+        puerto = self.server.server_address[1]
+        self.peticiones[puerto] = self.peticiones.get(puerto, 0) + 1
+        if puerto in self.rotos:
+            self.send_error(502)
+            return
+        try:
+            respuesta = self._directo.open(self.path, timeout=30)
+            estado, cuerpo, tipo = respuesta.status, respuesta.read(), respuesta.headers.get('Content-Type')
+        except urllib.error.HTTPError as e:
+            estado, cuerpo, tipo = e.code, e.read(), e.headers.get('Content-Type')
+        except OSError:
+            self.send_error(502)
+            return
+        self.send_response(estado)
+        self.send_header('Content-Type', tipo or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+# ---->API de telegram falsa
+
+class ManejadorTelegram(BaseHTTPRequestHandler):
+    llamadas = {}
+    _id = [0]
+    # updates que se entregan por getUpdates y momento de cada mensaje enviado por el bot
+    pendientes = []
+    respuestas = []
+    condicion = threading.Condition()
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        cuerpo = self.rfile.read(longitud) if longitud else b''
+        try:
+            datos = json.loads(cuerpo) if cuerpo else {}
+        except ValueError:
+            datos = {}
+        metodo = self.path.rstrip('/').split('/')[-1]
+        self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+        if metodo == 'getMe':
+            resultado = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif metodo == 'getUpdates':
+            # long polling como el de telegram, con la espera limitada a 10s
+            desplazamiento = int(datos.get('offset') or 0)
+            with self.condicion:
+                self.pendientes[:] = [u for u in self.pendientes if u['update_id'] >= desplazamiento]
+                self.condicion.wait_for(lambda: self.pendientes, timeout=min(float(datos.get('timeout') or 0), 10))
+                resultado = list(self.pendientes)
+        elif metodo in ('sendChatAction', 'setWebhook', 'deleteWebhook', 'answerCallbackQuery'):
+            resultado = True
+        else:
+            with self.condicion:
+                self.respuestas.append(time.time())
+                self.condicion.notify_all()
+            self._id[0] += 1
+            resultado = {'message_id': self._id[0], 'date': int(time.time()),
+                         'chat': {'id': CHAT_FALSO, 'type': 'private'}, 'text': ''}
+        cuerpo = json.dumps({'ok': True, 'result': resultado}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+# ---->updates grabados
+
+COMANDOS_GRABADOS = ['/start', '/help', '/status', '/stats', '/precios telefono', '/historial telefono']
+
+
+def updates_grabados(fichero):
+    """Lista de updates de telegram (json) a reproducir; sin fichero, comandos de solo lectura del admin
+    y un toque en "Ver contacto" del primer anuncio del historial"""
+    if fichero:
+        with open(fichero) as f:
+            return json.load(f)
+    updates = []
+    usuario = {'id': CHAT_FALSO, 'is_bot': False, 'first_name': 'bench'}
+    for comando in COMANDOS_GRABADOS:
+        updates.append({'message': {
+            'message_id': len(updates) + 1, 'date': int(time.time()), 'text': comando,
+            'chat': {'id': CHAT_FALSO, 'type': 'private'}, 'from': usuario,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(comando.split()[0])}],
+        }})
+    updates.append({'callback_query': {
+        'id': '1', 'from': usuario, 'chat_instance': '1', 'data': 'contacto:1',
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': CHAT_FALSO, 'type': 'private'},
+                    'text': 'Anuncio\nContacto: pulse Ver contacto'},
+    }})
+    return updates
+
+
+def reproducir(updates, modo, url_webhook):
+    """Entrega los updates de uno en uno (al webhook o por getUpdates) y mide hasta el primer mensaje del bot"""
+    tiempos = []
+    for i, update in enumerate(updates):
+        update = dict(update, update_id=i + 1)
+        with ManejadorTelegram.condicion:
+            antes = len(ManejadorTelegram.respuestas)
+        inicio = time.time()
+        if modo == 'webhook':
+            peticion = urllib.request.Request(url_webhook, data=json.dumps(update).encode(),
+                                              headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(peticion, timeout=10).read()
+        else:
+            with ManejadorTelegram.condicion:
+                ManejadorTelegram.pendientes.append(update)
+                ManejadorTelegram.condicion.notify_all()
+        with ManejadorTelegram.condicion:
+            if ManejadorTelegram.condicion.wait_for(lambda: len(ManejadorTelegram.respuestas) > antes, timeout=10):
+                tiempos.append(ManejadorTelegram.respuestas[antes] - inicio)
+        # que las respuestas tardias de este update no se cuenten para el siguiente
+        time.sleep(0.2)
+    return tiempos
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def levantar(manejador):
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, 'http://127.0.0.1:' + str(servidor.server_address[1])
+
+
+# ---->ejecucion
+
+def percentiles(tiempos):
+    if not tiempos:
+        return {}
+    ordenados = sorted(tiempos)
+
+    def p(valor):
+        return round(ordenados[min(len(ordenados) - 1, int(valor * len(ordenados)))], 4)
+
+    return {'p50': p(0.5), 'p90': p(0.9), 'p99': p(0.99), 'max': round(ordenados[-1], 4),
+            'media': round(sum(ordenados) / len(ordenados), 4)}
+
+
+def rss_arbol_kb(pid):
+    """RSS sumado del proceso y todos sus descendientes (chromedriver y chrome), leido de /proc"""
+    padres = {}
+    for entrada in os.listdir('/proc'):
+        if entrada.isdigit():
+            try:
+                with open('/proc/' + entrada + '/stat') as f:
+                    padres[int(entrada)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    arbol = {pid}
+    cambio = True
+    while cambio:
+        cambio = False
+        for hijo, padre in padres.items():
+            if padre in arbol and hijo not in arbol:
+                arbol.add(hijo)
+                cambio = True
+    total = 0
+    for proceso in arbol:
+        try:
+            with open('/proc/' + str(proceso) + '/status') as f:
+                for linea in f:
+                    if linea.startswith('VmRSS:'):
+                        total += int(linea.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+class MuestreoRSS(threading.Thread):
+    def __init__(self, intervalo=0.2):
+        super().__init__(daemon=True)
+        self.intervalo = intervalo
+        self.pico = 0
+        self.parar = threading.Event()
+
+    def run(self):
+        if not os.path.isdir('/proc'):
+            return
+        while not self.parar.is_set():
+            self.pico = max(self.pico, rss_arbol_kb(os.getpid()))
+            self.parar.wait(self.intervalo)
+
+
+def rss_max_kb(muestreo):
+    # ru_maxrss esta en KB en linux; RUSAGE_CHILDREN cubre chromedriver/chrome ya terminados
+    return {'proceso': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'hijos': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'arbol': muestreo.pico}
+
+
+def por_pagina(histogramas):
+    carga = histogramas.get('carga_pagina')
+    if not carga or not carga[-1]:
+        return 0
+    return round(carga[-2] / carga[-1], 4)
+
+
+def ejecutar(args):
+    ManejadorRevolico.parametros = {
+        'anuncios': args.anuncios, 'nuevos': args.nuevos, 'coincidencias': args.coincidencias,
+        'fotos': args.fotos, 'tamano': args.tamano, 'latencia': args.latencia / 1000.0,
+        'lentos': args.lentos, 'lentitud': args.lentitud / 1000.0,
+    }
+    servidor_revolico, url_revolico = levantar(ManejadorRevolico)
+    ManejadorRevolico.parametros['base'] = url_revolico
+    proxies = []
+    for i in range(args.proxies):
+        servidor_proxy, url_proxy = levantar(ManejadorProxy)
+        proxies.append(url_proxy)
+        if i < args.proxies_rotos:
+            ManejadorProxy.rotos.add(servidor_proxy.server_address[1])
+    servidor_telegram, url_telegram = levantar(ManejadorTelegram)
+
+    directorio = tempfile.mkdtemp(prefix='revolico_bench_')
+    os.chdir(directorio)
+    # los modulos del bot leen la configuracion al importarse
+    os.environ['REVOLICO_URL'] = url_revolico
+    os.environ['DB_PATH'] = os.path.join(directorio, 'anuncios.db')
+    os.environ['METRICAS'] = '1'
+    os.environ['TELEGRAM_API_URL'] = url_telegram + '/bot'
+    os.environ['NAVEGADOR_PERFIL'] = args.perfil
+    os.environ['BOT_MODO'] = args.modo_bot
+    os.environ['PROXIES'] = ",".join(proxies)
+    os.environ['CONTACTO_DIFERIDO'] = '1' if args.contacto_diferido else '0'
+    os.environ['DIGEST_VENTANA_S'] = str(args.digest)
+    puerto_webhook = puerto_libre()
+    os.environ['WEBHOOK_HOST'] = '127.0.0.1'
+    os.environ['WEBHOOK_PUERTO'] = str(puerto_webhook)
+    os.environ['WEBHOOK_URL'] = 'http://127.0.0.1:' + str(puerto_webhook)
+    muestreo = MuestreoRSS()
+    muestreo.start()
+
+    import metricas
+    import transporte
+    from db import crear_tabla_filtros, crear_tablas_estado, crear_tablas_historial, insertar_filtro
+    from scraper import get_main_anuncios
+    import main
+    from main import ciclo_busqueda
+    from telegram import Bot
+
+    crear_tabla_filtros()
+    crear_tablas_estado()
+    crear_tablas_historial()
+    for palabra in args.palabras.split(','):
+        insertar_filtro(args.departamento, palabra, None, None, 'La Habana', None, None)
+
+    resultado_listado = resultado_ciclo = None
+    # sin chromedriver solo se pueden medir los comandos
+    if not args.solo_comandos:
+        # listado: solo get_main_anuncios
+        metricas.reiniciar()
+        tiempos_listado = []
+        for i in range(args.repeticiones):
+            inicio = time.perf_counter()
+            get_main_anuncios(args.departamento, args.palabras.split(',')[0], None, None, 'La Habana')
+            tiempos_listado.append(time.perf_counter() - inicio)
+        vistos = metricas.contador('anuncios_vistos')
+        _, histogramas = metricas.instantanea()
+        resultado_listado = {
+            'repeticiones': args.repeticiones,
+            'anuncios_vistos': vistos,
+            'anuncios_por_segundo': round(vistos / sum(tiempos_listado), 2) if tiempos_listado else 0,
+            'latencia': percentiles(tiempos_listado),
+            'carga_por_pagina_s': por_pagina(histogramas),
+            'navegadores_lanzados': metricas.contador('navegadores_lanzados'),
+        }
+
+        # ciclo completo de buscar contra la API falsa
+        metricas.reiniciar()
+        bot = Bot(TOKEN_FALSO, base_url=url_telegram + '/bot')
+        tiempos_ciclo = []
+        hasta_alerta = []
+        for i in range(args.ciclos):
+            with ManejadorTelegram.condicion:
+                antes = len(ManejadorTelegram.respuestas)
+            comienzo = time.time()
+            inicio = time.perf_counter()
+            ciclo_busqueda(CHAT_FALSO, bot)
+            tiempos_ciclo.append(time.perf_counter() - inicio)
+            # desde que empieza la pasada hasta que sale cada mensaje de anuncio
+            with ManejadorTelegram.condicion:
+                hasta_alerta.extend(momento - comienzo for momento in ManejadorTelegram.respuestas[antes:])
+        # lo que quede en los resumenes sale como al parar la busqueda
+        main.repartir_resumenes(bot, forzar=True)
+        contadores, histogramas = metricas.instantanea()
+        enviados = metricas.contador('anuncios_enviados')
+        resultado_ciclo = {
+            'ciclos': args.ciclos,
+            'latencia': percentiles(tiempos_ciclo),
+            'hasta_alerta': percentiles(hasta_alerta),
+            'carga_por_pagina_s': por_pagina(histogramas),
+            'anuncios_vistos': metricas.contador('anuncios_vistos'),
+            'anuncios_coincidentes': metricas.contador('anuncios_coincidentes'),
+            'listados': metricas.contador('listados'),
+            'listados_sin_cambios': metricas.contador('listados_sin_cambios'),
+            'detalles': metricas.contador('detalles'),
+            'reintentos': sum(v for (nombre, _), v in contadores.items() if nombre == 'reintentos'),
+            'coberturas': metricas.contador('coberturas', etiqueta='detalle'),
+            'coberturas_ganadas': metricas.contador('coberturas_ganadas', etiqueta='detalle'),
+            'errores': sum(v for (nombre, _), v in contadores.items() if nombre == 'errores'),
+            'envios': metricas.contador('envios'),
+            'anuncios_enviados': enviados,
+            'resumenes': metricas.contador('resumenes'),
+            'llamadas_por_anuncio': round(metricas.contador('llamadas_telegram') / enviados, 2) if enviados else None,
+            'llamadas_ahorradas_por_anuncio': (round(metricas.contador('llamadas_evitadas') / enviados, 2)
+                                               if enviados else None),
+            'navegadores_lanzados': metricas.contador('navegadores_lanzados'),
+            'etapas': {etapa: {'n': h[-1], 'total_s': round(h[-2], 4)} for etapa, h in histogramas.items()},
+        }
+
+    # comandos: updates grabados entregados por webhook o por polling
+    metricas.reiniciar()
+    llamadas_antes = dict(ManejadorTelegram.llamadas)
+    updates = updates_grabados(args.updates)
+    updater = main.construir_updater(TOKEN_FALSO)
+    main.arrancar(updater)
+    url_webhook = 'http://127.0.0.1:' + str(puerto_webhook) + '/' + main.WEBHOOK_SECRETO
+    inicio = time.time()
+    tiempos_comandos = reproducir(updates, main.Modo_bot[0], url_webhook)
+    duracion = time.time() - inicio
+    rechazada = None
+    if main.Modo_bot[0] == 'webhook':
+        try:
+            urllib.request.urlopen(urllib.request.Request('http://127.0.0.1:' + str(puerto_webhook) + '/otra_ruta',
+                                                          data=b'{}'), timeout=10)
+            rechazada = False
+        except urllib.error.HTTPError as e:
+            rechazada = e.code == 404
+    updater.stop()
+    get_updates = ManejadorTelegram.llamadas.get('getUpdates', 0) - llamadas_antes.get('getUpdates', 0)
+    resultado_comandos = {
+        'modo': main.Modo_bot[0],
+        'updates': len(updates),
+        'respondidos': len(tiempos_comandos),
+        'latencia': percentiles(tiempos_comandos),
+        'getUpdates': get_updates,
+        'getUpdates_por_minuto': round(get_updates * 60 / duracion, 1) if duracion else 0,
+        'ruta_incorrecta_rechazada': rechazada,
+    }
+
+    muestreo.parar.set()
+    servidor_revolico.shutdown()
+    servidor_telegram.shutdown()
+    return {
+        'fecha': datetime.utcnow().isoformat() + 'Z',
+        'parametros': dict(ManejadorRevolico.parametros, ciclos=args.ciclos, repeticiones=args.repeticiones,
+                           departamento=args.departamento, palabras=args.palabras, perfil=args.perfil,
+                           modo_bot=args.modo_bot, contacto_diferido=args.contacto_diferido, digest=args.digest,
+                           proxies=args.proxies, proxies_rotos=args.proxies_rotos),
+        'listado': resultado_listado,
+        'ciclo': resultado_ciclo,
+        'comandos': resultado_comandos,
+        'rss_max_kb': rss_max_kb(muestreo),
+        'peticiones_revolico': dict(ManejadorRevolico.peticiones),
+        'llamadas_telegram': dict(ManejadorTelegram.llamadas),
+        'salidas': transporte.estado(),
+        'peticiones_proxy': {str(puerto): n for puerto, n in ManejadorProxy.peticiones.items()},
+    }
+
+
+def comparar(actual, anterior):
+    """Imprime la variacion de las cifras principales respecto a un resultado anterior"""
+    claves = [
+        ('listado', 'anuncios_por_segundo'), ('listado', 'latencia', 'p50'), ('listado', 'carga_por_pagina_s'),
+        ('ciclo', 'latencia', 'p50'), ('ciclo', 'latencia', 'p90'), ('ciclo', 'latencia', 'max'),
+        ('ciclo', 'hasta_alerta', 'p50'), ('ciclo', 'detalles'), ('ciclo', 'llamadas_por_anuncio'),
+        ('ciclo', 'carga_por_pagina_s'), ('ciclo', 'navegadores_lanzados'), ('comandos', 'latencia', 'p50'),
+        ('comandos', 'getUpdates_por_minuto'), ('rss_max_kb', 'proceso'), ('rss_max_kb', 'hijos'),
+        ('rss_max_kb', 'arbol'),
+    ]
+    for clave in claves:
+        a, b = actual, anterior
+        for parte in clave:
+            a = a.get(parte, {}) if isinstance(a, dict) else None
+            b = b.get(parte, {}) if isinstance(b, dict) else None
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            cambio = ((a - b) / b * 100) if b else 0
+            print("%-35s %12s -> %12s  (%+.1f%%)" % (".".join(clave), b, a, cambio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark offline del scraper y del ciclo de busqueda')
+    parser.add_argument('--anuncios', type=int, default=30, help='anuncios por pagina de listado')
+    parser.add_argument('--nuevos', type=int, default=5, help='anuncios publicados hace segundos')
+    parser.add_argument('--coincidencias', type=float, default=0.5, help='fraccion de anuncios con la palabra clave')
+    parser.add_argument('--fotos', type=float, default=0.3, help='fraccion de anuncios con fotos')
+    parser.add_argument('--tamano', type=int, default=300, help='bytes aproximados de cada descripcion')
+    parser.add_argument('--latencia', type=float, default=0, help='latencia de cada respuesta en ms')
+    parser.add_argument('--lentos', type=float, default=0, help='fraccion de paginas de anuncio que se cuelgan')
+    parser.add_argument('--lentitud', type=float, default=60000, help='cuanto se cuelgan esas paginas, en ms')
+    parser.add_argument('--repeticiones', type=int, default=3, help='ejecuciones de get_main_anuncios')
+    parser.add_argument('--ciclos', type=int, default=3, help='ciclos completos de buscar')
+    parser.add_argument('--departamento', default='compra-venta')
+    parser.add_argument('--palabras', default='telefono', help='palabras clave de los filtros, separadas por coma')
+    parser.add_argument('--perfil', default=os.environ.get('NAVEGADOR_PERFIL', 'completo'),
+                        choices=['completo', 'ligero'], help='perfil del navegador (ver NAVEGADOR_PERFIL)')
+    parser.add_argument('--modo-bot', default='webhook', choices=['polling', 'webhook'],
+                        help='como recibe el bot los updates grabados (ver BOT_MODO)')
+    parser.add_argument('--contacto-diferido', action='store_true',
+                        help='enviar los anuncios sin abrir su pagina (ver CONTACTO_DIFERIDO)')
+    parser.add_argument('--digest', type=float, default=0,
+                        help='segundos que se juntan los anuncios en un resumen (ver DIGEST_VENTANA_S)')
+    parser.add_argument('--solo-comandos', action='store_true',
+                        help='reproducir solo los updates, sin las etapas de scraping (no necesita chrome)')
+    parser.add_argument('--updates', help='fichero json con una lista de updates de telegram a reproducir')
+    parser.add_argument('--proxies', type=int, default=0, help='proxies locales de reenvio por los que sale el bot')
+    parser.add_argument('--proxies-rotos', type=int, default=0, help='cuantos de esos proxies responden 502 a todo')
+    parser.add_argument('--salida', help='fichero json donde guardar el resultado')
+    parser.add_argument('--comparar', help='resultado json anterior con el que comparar')
+    args = parser.parse_args()
+
+    anterior = None
+    if args.comparar:
+        with open(os.path.abspath(args.comparar)) as f:
+            anterior = json.load(f)
+    salida = os.path.abspath(args.salida) if args.salida else None
+
+    resultado = ejecutar(args)
+    texto = json.dumps(resultado, indent=2, sort_keys=True)
+    if salida:
+        with open(salida, 'w') as f:
+            f.write(texto)
+    else:
+        print(texto)
+    if anterior:
+        comparar(resultado, anterior)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
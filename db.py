@@ -1,14 +1,24 @@
+import json
+import logging
+import os
 import sqlite3
+import time
 from sqlite3 import Error
 
+from metricas import medir
+from precios import parsear_precio, cubo
+
+DB_PATH = os.environ.get('DB_PATH', 'anuncios.db')
+logger = logging.getLogger(__name__)
+
 
 def sql_connection():
     try:
-        conexion = sqlite3.connect('anuncios.db')
-        print("Conectado a la Db")
+        conexion = sqlite3.connect(DB_PATH)
+        logger.debug("Conectado a la Db")
         return conexion
     except Error:
-        print(Error)
+        logger.exception('No se pudo conectar a la Db')
 
 
 def crear_tabla_filtros():
@@ -19,10 +29,10 @@ def crear_tabla_filtros():
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS filtros(id integer PRIMARY KEY, departamento text,palabra_clave text, precio_min integer, precio_max integer, provincia text, municipio text, fotos text)")
         conexion.commit()
-        print("Creada tabla de filtros")
+        logger.debug("Creada tabla de filtros")
         conexion.close()
     except Exception as Error:
-        print(Error)
+        logger.exception(Error)
 
 
 def insertar_filtro(departamento,palabra_clave, precio_min=None, precio_max=None, provincia=None, municipio=None, fotos=False):
@@ -32,23 +42,23 @@ def insertar_filtro(departamento,palabra_clave, precio_min=None, precio_max=None
         cursor.execute(
             'INSERT INTO filtros( departamento,palabra_clave, precio_min, precio_max, provincia, municipio, fotos) VALUES( ?,?, ?, ?, ?, ?,?)',
             (departamento, palabra_clave, precio_min, precio_max, provincia, municipio, fotos))
-        print("Filtro insertado en la DB")
+        logger.info("Filtro insertado en la DB")
         conexion.commit()
     except Exception as e:
-        print(e)
+        logger.exception(e)
 
 
 def obtener_filtros():
     try:
-        conexion = sql_connection()
-        cursor = conexion.cursor()
-        cursor = conexion.execute("SELECT * from filtros")
-        filtros = cursor.fetchall()
-        print("Obtuve los filtros de la DB")
+        with medir('db'):
+            conexion = sql_connection()
+            cursor = conexion.execute("SELECT * from filtros")
+            filtros = cursor.fetchall()
+        logger.debug("Obtuve los filtros de la DB")
         conexion.close()
         return filtros
     except Exception as e:
-        print(e)
+        logger.exception(e)
 
 
 def actualizar_filtro(id, param, value):
@@ -58,10 +68,10 @@ def actualizar_filtro(id, param, value):
         query = 'UPDATE filtros set ' + str(param) + ' = ' + str(value) + ' where id = ' + str(id)
         cursor = conexion.execute(query)
         conexion.commit()
-        print("Filtro actualizado")
+        logger.info("Filtro actualizado")
         conexion.close()
     except Exception as e:
-        print(e)
+        logger.exception(e)
 
 
 def eliminar_filtro(id):
@@ -69,13 +79,14 @@ def eliminar_filtro(id):
         conexion = sql_connection()
 
         cursor = conexion.cursor()
-        cursor = conexion.execute("DELETE from filtros where id = ?;", id)
+        cursor = conexion.execute("DELETE from filtros where id = ?;", (id,))
+        conexion.execute("DELETE from cursores where filtro_id = ?;", (id,))
         conexion.commit()
-        print('Se elimino un filtro')
+        logger.info('Se elimino un filtro')
         conexion.close()
 
     except Exception as e:
-        print(e)
+        logger.exception(e)
 
 
 def eliminar_todos_los_filtros():
@@ -84,54 +95,379 @@ def eliminar_todos_los_filtros():
 
         cursor = conexion.cursor()
         cursor.execute("DROP TABLE IF EXISTS filtros")
+        cursor.execute("DELETE from cursores")
         crear_tabla_filtros()
         conexion.commit()
-        print("Todos los filtros eliminados")
+        logger.info("Todos los filtros eliminados")
         conexion.close()
 
     except Exception as e:
-        print(e)
+        logger.exception(e)
 
 
 def crear_tabla_anuncio():
     try:
-        conexion = sql_connection()
-        cursor = conexion.cursor()
+        with medir('db'):
+            conexion = sql_connection()
+            cursor = conexion.cursor()
 
-        cursor.execute("DROP TABLE IF EXISTS anuncios")
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS anuncios(id integer PRIMARY KEY, url text, titulo text, precio text, descripcion text, fecha text, ubicacion text,foto text)")
-        conexion.commit()
-        print("creada tabla anuncio en la db")
+            cursor.execute("DROP TABLE IF EXISTS anuncios")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS anuncios(id integer PRIMARY KEY, url text, titulo text, precio text, descripcion text, fecha text, ubicacion text,foto text)")
+            conexion.commit()
+        logger.debug("creada tabla anuncio en la db")
         conexion.close()
     except Exception as Error:
-        print(Error)
+        logger.exception(Error)
 
 
 def insertar_anuncio(url, titulo, precio, descripcion, fecha, ubicacion, foto):
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            cursor = conexion.cursor()
+            cursor.execute(
+                'INSERT INTO anuncios( url, titulo, precio, descripcion, fecha, ubicacion, foto) VALUES( ?, ?, ?, ?, ?,?,?)',
+                (url, titulo, precio, descripcion, fecha, ubicacion, foto))
+            conexion.commit()
+        logger.debug("Se inserto anuncio en la db")
+    except Exception as e:
+        logger.exception(e)
+
+
+def obtener_anuncios():
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            cursor = conexion.execute("SELECT * from anuncios")
+            anuncios = cursor.fetchall()
+        logger.debug("Obtuve anuncios de la DB")
+        conexion.close()
+        return anuncios
+    except Exception as e:
+        logger.exception(e)
+
+
+# ---->estado persistente del bot (sobrevive a los reinicios del dyno)
+
+def crear_tablas_estado():
     try:
         conexion = sql_connection()
         cursor = conexion.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS usuarios(id text PRIMARY KEY)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS busquedas(chat_id text PRIMARY KEY, estado text, actualizado real)")
         cursor.execute(
-            'INSERT INTO anuncios( url, titulo, precio, descripcion, fecha, ubicacion, foto) VALUES( ?, ?, ?, ?, ?,?,?)',
-            (url, titulo, precio, descripcion, fecha, ubicacion, foto))
-        print("Se inserto anuncio en la db")
+            "CREATE TABLE IF NOT EXISTS cursores(filtro_id integer PRIMARY KEY, ultimo_anuncio text, ultimo_run real,"
+            " huella text)")
+        # las bases creadas antes de guardar la huella del listado no tienen la columna
+        columnas = [fila[1] for fila in cursor.execute("PRAGMA table_info(cursores)")]
+        if 'huella' not in columnas:
+            cursor.execute("ALTER TABLE cursores ADD COLUMN huella text")
+        cursor.execute("CREATE TABLE IF NOT EXISTS anuncios_vistos(url text PRIMARY KEY, filtro_id integer, visto real)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_anuncios_vistos_visto ON anuncios_vistos(visto)")
         conexion.commit()
+        logger.debug("Creadas las tablas de estado")
+        conexion.close()
     except Exception as e:
-        print(e)
+        logger.exception(e)
 
 
-def obtener_anuncios():
+def guardar_usuario(id):
+    try:
+        conexion = sql_connection()
+        conexion.execute("INSERT OR IGNORE INTO usuarios(id) VALUES(?)", (str(id),))
+        conexion.commit()
+        conexion.close()
+    except Exception as e:
+        logger.exception(e)
+
+
+def obtener_usuarios():
+    try:
+        conexion = sql_connection()
+        usuarios = [fila[0] for fila in conexion.execute("SELECT id from usuarios")]
+        conexion.close()
+        return usuarios
+    except Exception as e:
+        logger.exception(e)
+        return []
+
+
+def guardar_busqueda(chat_id, estado):
+    try:
+        conexion = sql_connection()
+        conexion.execute("INSERT OR REPLACE INTO busquedas(chat_id, estado, actualizado) VALUES(?, ?, ?)",
+                         (str(chat_id), estado, time.time()))
+        conexion.commit()
+        conexion.close()
+    except Exception as e:
+        logger.exception(e)
+
+
+def detener_busquedas():
+    try:
+        conexion = sql_connection()
+        conexion.execute("UPDATE busquedas set estado = 'detenido', actualizado = ?", (time.time(),))
+        conexion.commit()
+        conexion.close()
+    except Exception as e:
+        logger.exception(e)
+
+
+def obtener_busquedas_activas():
+    try:
+        conexion = sql_connection()
+        chats = [fila[0] for fila in conexion.execute(
+            "SELECT chat_id from busquedas where estado = 'funcionando' ORDER BY actualizado")]
+        conexion.close()
+        return chats
+    except Exception as e:
+        logger.exception(e)
+        return []
+
+
+def guardar_cursor(filtro_id, ultimo_anuncio, ultimo_run, huella=None):
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            conexion.execute(
+                "INSERT OR REPLACE INTO cursores(filtro_id, ultimo_anuncio, ultimo_run, huella) VALUES(?, ?, ?, ?)",
+                (filtro_id, ultimo_anuncio, ultimo_run, huella))
+            conexion.commit()
+            conexion.close()
+    except Exception as e:
+        logger.exception(e)
+
+
+def obtener_cursores():
+    """{filtro_id: (ultimo_anuncio, ultimo_run, huella)}"""
+    try:
+        conexion = sql_connection()
+        cursores = {fila[0]: (fila[1], fila[2], fila[3]) for fila in
+                    conexion.execute("SELECT filtro_id, ultimo_anuncio, ultimo_run, huella from cursores")}
+        conexion.close()
+        return cursores
+    except Exception as e:
+        logger.exception(e)
+        return {}
+
+
+def marcar_visto(url, filtro_id):
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            conexion.execute("INSERT OR REPLACE INTO anuncios_vistos(url, filtro_id, visto) VALUES(?, ?, ?)",
+                             (url, filtro_id, time.time()))
+            conexion.commit()
+            conexion.close()
+    except Exception as e:
+        logger.exception(e)
+
+
+def obtener_vistos(dias=7):
+    """Urls de los anuncios ya enviados en los ultimos `dias`; borra los mas viejos"""
+    try:
+        limite = time.time() - dias * 86400
+        conexion = sql_connection()
+        conexion.execute("DELETE from anuncios_vistos where visto < ?", (limite,))
+        conexion.commit()
+        vistos = {fila[0] for fila in conexion.execute("SELECT url from anuncios_vistos")}
+        conexion.close()
+        return vistos
+    except Exception as e:
+        logger.exception(e)
+        return set()
+
+
+# ---->historial de anuncios y estadisticas de precios por palabra clave
+
+def crear_tablas_historial():
     try:
         conexion = sql_connection()
         cursor = conexion.cursor()
-        cursor = conexion.execute("SELECT * from anuncios")
-        anuncios = cursor.fetchall()
-        print("Obtuve anuncios de la DB")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS historial_anuncios(id integer PRIMARY KEY, url text UNIQUE, palabra_clave text, "
+            "departamento text, titulo text, descripcion text, ubicacion text, precio_texto text, precio real, "
+            "moneda text, fecha text, visto real)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_palabra ON historial_anuncios(palabra_clave, visto)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_departamento ON historial_anuncios(departamento, visto)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_visto ON historial_anuncios(visto)")
+        # indice de texto completo sobre el historial (contenido externo: no duplica el texto)
+        existe = cursor.execute("SELECT name from sqlite_master where name = 'anuncios_fts'").fetchone()
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS anuncios_fts USING fts5(titulo, descripcion, ubicacion, "
+            "content='historial_anuncios', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        if not existe:
+            cursor.execute("INSERT INTO anuncios_fts(anuncios_fts) VALUES('rebuild')")
+        # agregados que se actualizan en cada insercion: /precios no recorre el historial
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS estadisticas_precios(palabra_clave text, moneda text, cantidad integer, "
+            "minimo real, maximo real, suma real, cubos text, PRIMARY KEY(palabra_clave, moneda))")
+        # anuncios ya contados en las estadisticas de cada palabra clave: un anuncio puede coincidir con varias
+        existe = cursor.execute("SELECT name from sqlite_master where name = 'precios_contados'").fetchone()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS precios_contados(palabra_clave text, url text, "
+            "PRIMARY KEY(palabra_clave, url)) WITHOUT ROWID")
+        if not existe:
+            # los del historial anterior ya estan en las estadisticas de la palabra con la que se guardaron
+            cursor.execute("INSERT OR IGNORE INTO precios_contados(palabra_clave, url) "
+                           "SELECT palabra_clave, url from historial_anuncios where precio is not null")
+        # contactos ya sacados de la pagina de cada anuncio (boton "Ver contacto")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS contactos(url text PRIMARY KEY, contacto text, telefono text, email text, "
+            "obtenido real)")
+        conexion.commit()
+        logger.debug("Creadas las tablas del historial")
         conexion.close()
-        return anuncios
     except Exception as e:
-        print(e)
+        logger.exception(e)
 
 
+def archivar_anuncios(departamento, palabra_clave, anuncios, visto=None):
+    """Guarda en el historial los anuncios de un listado y actualiza las estadisticas de los que coinciden.
+
+    `anuncios` es una lista de dicts con url, titulo, precio, descripcion, fecha, ubicacion y coincide; `visto` es
+    el momento de la descarga (por defecto ahora, distinto al reparsear el archivo). Devuelve cuantos eran nuevos.
+    """
+    palabra_clave = str(palabra_clave).lower()
+    nuevos = 0
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            cursor = conexion.cursor()
+            agregados = {}
+            ahora = visto or time.time()
+            for anuncio in anuncios:
+                monto, moneda = parsear_precio(anuncio['precio'])
+                cursor.execute(
+                    'INSERT OR IGNORE INTO historial_anuncios(url, palabra_clave, departamento, titulo, descripcion, '
+                    'ubicacion, precio_texto, precio, moneda, fecha, visto) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (anuncio['url'], palabra_clave, departamento, anuncio['titulo'], anuncio['descripcion'],
+                     anuncio['ubicacion'], anuncio['precio'], monto, moneda, anuncio['fecha'], ahora))
+                if cursor.rowcount == 1:
+                    nuevos += 1
+                    cursor.execute('INSERT INTO anuncios_fts(rowid, titulo, descripcion, ubicacion) VALUES(?, ?, ?, ?)',
+                                   (cursor.lastrowid, anuncio['titulo'], anuncio['descripcion'], anuncio['ubicacion']))
+                if monto is None or not anuncio.get('coincide'):
+                    continue
+                # el historial guarda cada url una vez; las estadisticas, una vez por palabra clave
+                cursor.execute('INSERT OR IGNORE INTO precios_contados(palabra_clave, url) VALUES(?, ?)',
+                               (palabra_clave, anuncio['url']))
+                if cursor.rowcount == 1:
+                    agregados.setdefault(moneda, []).append(monto)
+            for moneda, montos in agregados.items():
+                _actualizar_estadisticas(cursor, palabra_clave, moneda, montos)
+            conexion.commit()
+            conexion.close()
+    except Exception as e:
+        logger.exception(e)
+    return nuevos
 
+
+def _actualizar_estadisticas(cursor, palabra_clave, moneda, montos):
+    fila = cursor.execute(
+        "SELECT cantidad, minimo, maximo, suma, cubos from estadisticas_precios where palabra_clave = ? and moneda = ?",
+        (palabra_clave, moneda)).fetchone()
+    if fila:
+        cantidad, minimo, maximo, suma, cubos = fila[0], fila[1], fila[2], fila[3], json.loads(fila[4])
+    else:
+        cantidad, minimo, maximo, suma, cubos = 0, None, None, 0.0, {}
+    for monto in montos:
+        cantidad += 1
+        suma += monto
+        minimo = monto if minimo is None else min(minimo, monto)
+        maximo = monto if maximo is None else max(maximo, monto)
+        indice = str(cubo(monto))
+        cubos[indice] = cubos.get(indice, 0) + 1
+    cursor.execute(
+        "INSERT OR REPLACE INTO estadisticas_precios(palabra_clave, moneda, cantidad, minimo, maximo, suma, cubos) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?)", (palabra_clave, moneda, cantidad, minimo, maximo, suma, json.dumps(cubos)))
+
+
+def obtener_estadisticas_precios(palabra_clave):
+    """[(moneda, cantidad, minimo, maximo, suma, {cubo: cantidad}), ...]"""
+    try:
+        conexion = sql_connection()
+        filas = conexion.execute(
+            "SELECT moneda, cantidad, minimo, maximo, suma, cubos from estadisticas_precios where palabra_clave = ? "
+            "ORDER BY cantidad DESC", (str(palabra_clave).lower(),)).fetchall()
+        conexion.close()
+        return [(f[0], f[1], f[2], f[3], f[4], json.loads(f[5])) for f in filas]
+    except Exception as e:
+        logger.exception(e)
+        return []
+
+
+def buscar_historial(consulta, pagina=1, por_pagina=5):
+    """Busca en el historial por titulo, descripcion y ubicacion, ordenado por relevancia.
+
+    Devuelve (resultados, hay_mas) con resultados = [(url, titulo, precio_texto, ubicacion, visto), ...].
+    """
+    # cada palabra entre comillas: se buscan todas y no se interpreta la sintaxis de fts5
+    palabras = [palabra.replace('"', '') for palabra in str(consulta).split()]
+    terminos = " ".join('"' + palabra + '"' for palabra in palabras if palabra)
+    if not terminos:
+        return [], False
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            filas = conexion.execute(
+                "SELECT h.url, h.titulo, h.precio_texto, h.ubicacion, h.visto FROM anuncios_fts "
+                "JOIN historial_anuncios h ON h.id = anuncios_fts.rowid WHERE anuncios_fts MATCH ? "
+                "ORDER BY bm25(anuncios_fts, 10.0, 1.0, 2.0), h.visto DESC LIMIT ? OFFSET ?",
+                (terminos, por_pagina + 1, (pagina - 1) * por_pagina)).fetchall()
+            conexion.close()
+        return filas[:por_pagina], len(filas) > por_pagina
+    except Exception as e:
+        logger.exception(e)
+        return [], False
+
+
+def obtener_id_historial(url):
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            fila = conexion.execute("SELECT id from historial_anuncios where url = ?", (url,)).fetchone()
+            conexion.close()
+        return fila[0] if fila else None
+    except Exception as e:
+        logger.exception(e)
+        return None
+
+
+def obtener_url_historial(id):
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            fila = conexion.execute("SELECT url from historial_anuncios where id = ?", (id,)).fetchone()
+            conexion.close()
+        return fila[0] if fila else None
+    except Exception as e:
+        logger.exception(e)
+        return None
+
+
+def guardar_contacto(url, contacto, telefono, email):
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            conexion.execute(
+                "INSERT OR REPLACE INTO contactos(url, contacto, telefono, email, obtenido) VALUES(?, ?, ?, ?, ?)",
+                (url, contacto, telefono, email, time.time()))
+            conexion.commit()
+            conexion.close()
+    except Exception as e:
+        logger.exception(e)
+
+
+def obtener_contacto_guardado(url):
+    """(contacto, telefono, email) si ya se saco de la pagina del anuncio, si no None"""
+    try:
+        with medir('db'):
+            conexion = sql_connection()
+            fila = conexion.execute("SELECT contacto, telefono, email from contactos where url = ?", (url,)).fetchone()
+            conexion.close()
+        return fila
+    except Exception as e:
+        logger.exception(e)
+        return None
@@ -0,0 +1,136 @@
+import os
+import re
+import unicodedata
+from datetime import datetime, timedelta, timezone
+
+import pytz
+
+# revolico muestra las fechas en hora de cuba
+ZONA = pytz.timezone('Cuba')
+
+UNIDADES = {
+    'segundo': 1, 'seg': 1, 's': 1,
+    'minuto': 60, 'min': 60, 'm': 60,
+    'hora': 3600, 'h': 3600, 'hr': 3600,
+    'dia': 86400, 'd': 86400,
+    'semana': 7 * 86400,
+    'mes': 30 * 86400,
+    'ano': 365 * 86400,
+}
+NUMEROS = {'un': 1, 'una': 1, 'uno': 1, 'unos': 1, 'unas': 1, 'dos': 2, 'tres': 3, 'pocos': 1, 'algunos': 1}
+MESES = {
+    'ene': 1, 'feb': 2, 'mar': 3, 'abr': 4, 'may': 5, 'jun': 6, 'jul': 7, 'ago': 8, 'sep': 9, 'set': 9, 'oct': 10,
+    'nov': 11, 'dic': 12,
+}
+
+_RELATIVA = re.compile(r'(\d+|[a-z]+)?\s*(segundos?|seg|minutos?|min|horas?|hr|h|dias?|d|semanas?|mes(?:es)?|anos?)\b')
+_HORA = re.compile(r'(\d{1,2}):(\d{2})(?:\s*([ap])\.?\s*m\b\.?)?')
+_NUMERICA = re.compile(r'(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})')
+_TEXTO = re.compile(r'(\d{1,2})\s+(?:de\s+)?([a-z]{3})[a-z]*\.?(?:\s+(?:de\s+)?(\d{4}))?')
+
+
+def _normalizar(texto):
+    texto = unicodedata.normalize('NFKD', str(texto)).encode('ascii', 'ignore').decode()
+    return texto.lower().strip()
+
+
+def parsear_fecha(texto, ahora=None):
+    """Convierte la fecha de un anuncio ('hace 5 minutos', 'ayer 10:30', 'hoy 3:45 p.m.', '12/03/2022'...) a UTC.
+
+    Devuelve el instante mas reciente compatible con el texto ('hace 2 horas' -> ahora - 2h, una fecha sin hora ->
+    el final de ese dia), para que al comparar con una ventana no se pierdan anuncios. None si no se entiende.
+    """
+    if ahora is None:
+        ahora = datetime.now(timezone.utc)
+    texto = _normalizar(texto)
+    if not texto or texto == 'no tiene':
+        return None
+    if texto in ('ahora', 'ahora mismo', 'justo ahora') or 'instantes' in texto:
+        return ahora
+
+    relativa = _RELATIVA.search(texto)
+    if relativa and ('hace' in texto or relativa.group(1) is not None):
+        cantidad = relativa.group(1)
+        if cantidad is None:
+            cantidad = 1
+        elif cantidad.isdigit():
+            cantidad = int(cantidad)
+        else:
+            cantidad = NUMEROS.get(cantidad, 1)
+        unidad = relativa.group(2)
+        segundos = UNIDADES.get(unidad) or UNIDADES.get(unidad.rstrip('s')) or UNIDADES.get(unidad[:-2])
+        if segundos:
+            return ahora - timedelta(seconds=cantidad * segundos)
+
+    local = ahora.astimezone(ZONA)
+    dia = None
+    if texto.startswith('hoy'):
+        dia = local.date()
+    elif texto.startswith('ayer'):
+        dia = local.date() - timedelta(days=1)
+    else:
+        numerica = _NUMERICA.search(texto)
+        textual = _TEXTO.search(texto)
+        try:
+            if numerica:
+                anio = int(numerica.group(3))
+                dia = datetime(anio + 2000 if anio < 100 else anio, int(numerica.group(2)), int(numerica.group(1))).date()
+            elif textual and textual.group(2) in MESES:
+                anio = int(textual.group(3)) if textual.group(3) else local.year
+                dia = datetime(anio, MESES[textual.group(2)], int(textual.group(1))).date()
+                if not textual.group(3) and dia > local.date():
+                    dia = dia.replace(year=anio - 1)
+        except ValueError:
+            return None
+    if dia is None:
+        return None
+
+    hora = _HORA.search(texto)
+    if not hora:
+        return min(_instante(dia, 23, 59), ahora)
+    horas, minutos, sufijo = int(hora.group(1)), int(hora.group(2)), hora.group(3)
+    if horas > 23 or minutos > 59:
+        return None
+    if sufijo == 'a' and horas == 12:
+        candidatas = [0]
+    elif sufijo == 'p' and horas < 12:
+        candidatas = [horas + 12]
+    elif sufijo is None and 1 <= horas <= 11:
+        # sin a.m./p.m. no se sabe si es formato de 12 horas: vale la lectura mas tardia que no este en el futuro
+        candidatas = [horas, horas + 12]
+    else:
+        candidatas = [horas]
+    instantes = [_instante(dia, candidata, minutos) for candidata in candidatas]
+    pasados = [instante for instante in instantes if instante <= ahora]
+    return max(pasados) if pasados else min(min(instantes), ahora)
+
+
+def _instante(dia, horas, minutos):
+    """Final del minuto `horas:minutos` de `dia` en hora de cuba, en UTC"""
+    momento = datetime(dia.year, dia.month, dia.day, horas, minutos, 59)
+    return ZONA.localize(momento).astimezone(timezone.utc)
+
+
+# primera pasada de un filtro sin cursor: solo anuncios de hace menos de un minuto (como el viejo filtro 'segundos')
+VENTANA_INICIAL = int(os.environ.get('FECHA_VENTANA_INICIAL_S', 60))
+# solape con la pasada anterior, para cubrir la imprecision de 'hace N minutos'
+MARGEN = int(os.environ.get('FECHA_MARGEN_S', 120))
+# tras una parada larga no se recuperan anuncios mas viejos que esto
+VENTANA_MAXIMA = int(os.environ.get('FECHA_VENTANA_MAXIMA_S', 6 * 3600))
+
+
+def ventana_desde(ultimo_run, ahora=None):
+    """Instante UTC a partir del cual se aceptan anuncios, segun la ultima pasada del filtro (timestamp o None)"""
+    if ahora is None:
+        ahora = datetime.now(timezone.utc)
+    if ultimo_run is None:
+        return ahora - timedelta(seconds=VENTANA_INICIAL)
+    desde = datetime.fromtimestamp(ultimo_run, timezone.utc) - timedelta(seconds=MARGEN)
+    return max(desde, ahora - timedelta(seconds=VENTANA_MAXIMA))
+
+
+def en_ventana(texto, desde):
+    publicado = parsear_fecha(texto)
+    if publicado is None:
+        return str(texto).find('segundos') != -1
+    return publicado >= desde
@@ -3,22 +3,60 @@ from emoji import emojize
 import requests
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update, ChatAction
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackQueryHandler, \
-    CallbackContext, JobQueue
-from db import insertar_filtro, obtener_filtros, obtener_anuncios, eliminar_filtro, eliminar_todos_los_filtros
-from scraper import get_main_anuncios, obtener_imagenes, obtener_contacto
+    CallbackContext, JobQueue, TypeHandler
+from db import insertar_filtro, obtener_filtros, obtener_anuncios, eliminar_filtro, eliminar_todos_los_filtros, \
+    crear_tabla_filtros, crear_tablas_estado, guardar_usuario, obtener_usuarios, guardar_busqueda, detener_busquedas, \
+    obtener_busquedas_activas, guardar_cursor, obtener_cursores, marcar_visto, obtener_vistos, crear_tablas_historial, \
+    obtener_estadisticas_precios, buscar_historial, obtener_id_historial, obtener_url_historial, guardar_contacto, \
+    obtener_contacto_guardado
+from precios import percentil_cubos
+from fechas import ventana_desde
+from scraper import get_main_anuncios, obtener_imagenes, obtener_contacto, REVOLICO_URL
+from metricas import medir, incrementar, resumen, iniciar_servidor, HABILITADO
+import perfilador
+import registro
+import resiliencia
+import supervisor
 import os, time
+import secrets
+import socket
 import threading
 from datetime import datetime
 import pytz
 
-# PORT = int(os.environ.get('PORT', 8443))
-
 # Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO)
+registro.configurar()
 
 logger = logging.getLogger(__name__)
 TOKEN = os.getenv('TOKEN')
+# permite apuntar el bot a otra API de telegram (ej. la falsa de benchmark.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# 'polling' (por defecto) o 'webhook': telegram entrega los updates a un servidor http del propio bot
+BOT_MODO = os.getenv('BOT_MODO', 'polling')
+# url publica (https) del webhook; en heroku se deduce de HEROKU_APP_NAME
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or (
+    'https://' + os.getenv('HEROKU_APP_NAME') + '.herokuapp.com' if os.getenv('HEROKU_APP_NAME') else None)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PUERTO = int(os.getenv('WEBHOOK_PUERTO') or os.getenv('PORT') or 8443)
+# unica ruta que acepta el servidor del webhook (cualquier otra responde 404); si no se define cambia en cada arranque
+WEBHOOK_SECRETO = os.getenv('WEBHOOK_SECRETO') or secrets.token_urlsafe(32)
+# hilos que atienden los comandos que no modifican estado
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 4))
+# 1: los anuncios se envian sin abrir su pagina; el contacto se busca cuando alguien pulsa "Ver contacto"
+CONTACTO_DIFERIDO = os.getenv('CONTACTO_DIFERIDO', '0') == '1'
+CONTACTO_PENDIENTE = "Contacto: pulse Ver contacto"
+# busquedas de /historial que se recuerdan por chat para el boton "Mas resultados"
+CONSULTAS_HISTORIAL = 20
+# canal donde se copia cada anuncio enviado
+CANAL_ID = "-1001598585439"
+# DIGEST_VENTANA_S > 0: los anuncios de cada chat se juntan durante ese tiempo (o hasta DIGEST_MAX) y salen en un
+# solo mensaje con un boton por anuncio; si se juntan menos de DIGEST_MINIMO se envian sueltos como siempre
+DIGEST_VENTANA = float(os.getenv('DIGEST_VENTANA_S', 0))
+# telegram no admite mas de 100 botones por mensaje
+DIGEST_MAX = min(int(os.getenv('DIGEST_MAX', 10)), 100)
+DIGEST_MINIMO = int(os.getenv('DIGEST_MINIMO', 3))
+# chats que reciben resumenes, separados por coma (vacio = todos); el canal recibe lo mismo que el chat de la busqueda
+DIGEST_CHATS = [chat.strip() for chat in os.getenv('DIGEST_CHATS', '').split(',') if chat.strip()]
 
 
 class boton:
@@ -27,12 +65,21 @@ class boton:
 
 
 Hilo_status = ['detenido']
+Modo_bot = [None]
 stop_threads = [False]
 Filtros = []
 borrar_filtro = 1
 introducir_datos_filtro, end = range(2)
 anadir_usuarios = 1
 Users_id = ['1122914981']
+ADMIN_ID = 1122914981
+# segundos entre dos pasadas por todos los filtros
+INTERVALO_BUSQUEDA = float(os.getenv('INTERVALO_BUSQUEDA', 0.1))
+# cache del estado persistente: {filtro_id: (ultimo_anuncio, ultimo_run, huella)} y urls ya enviadas
+Cursores = {}
+Vistos = set()
+# anuncios esperando a salir en un resumen: {chat_id: {'desde': timestamp, 'anuncios': [(anuncio, palabra_clave, filtro_id)]}}
+Resumenes = {}
 botones_boorar_usuario =[]
 
 # ---Autentificar usuarios
@@ -42,8 +89,7 @@ def autentificar(update, context):
     for user in Users_id:
         if str(update.effective_user['id']) == str(user):
             return True
-        else:
-            return False
+    return False
 
 
 def add_user(update, context):
@@ -57,6 +103,7 @@ def add_user(update, context):
 def usuario_recibido(update, context):
     user = update.message.text
     Users_id.append(str(user))
+    guardar_usuario(user)
     update.message.reply_text('Usuario añadido correctamente, aqui estan todos')
     update.message.reply_text(Users_id)
     return ConversationHandler.END
@@ -91,98 +138,271 @@ def show_user(update,context):
 
 
 # ----->funciones independientes
-def buscar(upd, context):
-    CHATID = upd.message.chat_id
-    bot = context.bot
-
+def buscar(CHATID, bot):
     while True:
         if stop_threads[0]:
+            # lo que quede acumulado sale antes de terminar
+            repartir_resumenes(bot, forzar=True)
             break
 
-        try:
-            filtros = obtener_filtros()
-            for filtro in filtros:
-
-                id = filtro[0]
-                dep = filtro[1]
-                palabra_clave = filtro[2]
-                precio_min = filtro[3]
-                precio_max = filtro[4]
-                provincia = filtro[5]
-                municipio = filtro[6]
-                fotos = filtro[7]
-
-                get_main_anuncios(dep, palabra_clave, precio_min, precio_max, provincia, municipio, fotos)
-                anuncios = obtener_anuncios()
-                for anuncio in anuncios:
-                    id = anuncio[0]
-                    url = "https://www.revolico.com" + str(anuncio[1])
-                    titulo = anuncio[2]
-                    precio = anuncio[3]
-                    descripcion = anuncio[4]
-                    fecha = anuncio[5]
-                    ubicacion = anuncio[6]
-                    foto = anuncio[7]
-                    Contacto, telefono, email = obtener_contacto(url)
-
-                    print(titulo)
-                    dt = datetime.now(pytz.timezone('Cuba'))
-                    hora = dt.strftime('%Y-%m-%d a las %H:%M:%S')
-
-                    info = (
-                            "#" + str(palabra_clave) + "\n" + str(titulo) + "\n\n"
-                            + "Precio: " + str(precio) + "\n\n\n"
-                            + "descripcion: \n" + str(descripcion) + "\n\n\n"
-                            + "fecha: " + str(hora) + "\n"
-                            + "ubicacion: " + str(ubicacion) + "\n"
-                            + "Contacto: " + str(Contacto) + "\n"
-                            + "Email: " + str(email) + "\n"
-                            + "Telefono: #" + str(telefono) + "\n\n"
-                    )
-
-                    boton = InlineKeyboardButton("Ver anuncio", url)
-                    markup = InlineKeyboardMarkup([
-                        [boton]
-                    ])
-
-                    # print("Esta es la info: "+str(info))
-                    if foto != 0 and foto != 'no tiene':
-                        print("Estoy dentro de un anuncio con foto")
-                        src_img = obtener_imagenes(url)
-                        if src_img:
-                            print("Voy a enviar una anuncio con imagen")
-                            ft = open("foto.jpg", "rb")
-                            # inf =str(info)+'<a href="'+ src_img +'">&#8205;</a>'
-                            chat = upd.message.chat
-                            chat.send_action(action=ChatAction.UPLOAD_PHOTO)
-                            # upd.message.reply_text(text=inf, parse_mode="HTML", reply_markup=markup)
-                            upd.message.reply_photo(photo=ft, caption=info, reply_markup=markup)
-                            # -1001598585439
-                            print("enviando mensaje al PV")
-                            print(info)
-                            
-                            context.bot.send_message(
-                                chat_id="-1001598585439",
-                                text=info,
-                                reply_markup=markup
-                            )
-                            print("enviando mensaje al canal")
-                    else:
-                        # chat.send_action(action=ChatAction.TYPING)
-                        print("Voy a enviar una anuncio sin imagen")
-                        context.bot.send_message(CHATID, info, reply_markup=markup)
-                        print(info)
-                        context.bot.send_message(
-                                chat_id="-1001598585439",
-                                text=info,
-                                reply_markup=markup
-                            )
-
-                time.sleep(0.1)
+        if not resiliencia.CIRCUITO.permite():
+            # revolico esta fallando: no se descarga nada hasta que termine la pausa del circuito
+            esperar(resiliencia.CIRCUITO.restante())
+            continue
 
+        try:
+            with perfilador.perfilar_ciclo():
+                with medir('ciclo'):
+                    ciclo_busqueda(CHATID, bot)
+            esperar(INTERVALO_BUSQUEDA)
+        except Exception as e:
+            logger.exception(e)
+
+        fichero_perfil = perfilador.recoger()
+        if fichero_perfil:
+            try:
+                with open(fichero_perfil, 'rb') as doc:
+                    bot.send_document(ADMIN_ID, doc, caption='Perfil de los ultimos ciclos de busqueda')
+            except Exception as e:
+                logger.exception(e)
+
+
+def esperar(segundos):
+    """time.sleep que se corta en cuanto se pide /stop"""
+    fin = time.time() + segundos
+    while not stop_threads[0] and time.time() < fin:
+        time.sleep(min(1, max(0, fin - time.time())))
+
+
+def ciclo_busqueda(CHATID, bot):
+    """Una pasada completa por todos los filtros"""
+    filtros = obtener_filtros()
+    for filtro in filtros:
+
+        filtro_id = filtro[0]
+        dep = filtro[1]
+        palabra_clave = filtro[2]
+        precio_min = filtro[3]
+        precio_max = filtro[4]
+        provincia = filtro[5]
+        municipio = filtro[6]
+        fotos = filtro[7]
+
+        inicio = time.time()
+        ultimo_anuncio, ultimo_run, ultima_huella = Cursores.get(filtro_id, (None, None, None))
+        circuito = resiliencia.circuito_listado(filtro_id)
+        if not circuito.permite():
+            # este filtro esta en pausa; su cursor no se toca
+            continue
+        try:
+            with medir('listado'):
+                mas_reciente, huella = get_main_anuncios(dep, palabra_clave, precio_min, precio_max, provincia,
+                                                         municipio, fotos, vistos=Vistos,
+                                                         desde=ventana_desde(ultimo_run),
+                                                         huella_anterior=ultima_huella, circuito=circuito)
+        except Exception as e:
+            # un listado que falla (o cuyo circuito se acaba de abrir) no corta la pasada: los demas filtros siguen
+            # y este se reintenta en la proxima con el cursor como estaba
+            logger.warning('No se pudo descargar el listado',
+                           extra={'datos': {'filtro_id': filtro_id, 'palabra_clave': palabra_clave,
+                                            'error': str(e)[:200]}})
+            continue
+        if huella is not None and huella == ultima_huella:
+            # mismo listado que la pasada anterior: no hay nada nuevo que enviar ni que guardar en la DB
+            Cursores[filtro_id] = (mas_reciente or ultimo_anuncio, inicio, huella)
             time.sleep(0.1)
+            continue
+        anuncios = obtener_anuncios()
+        fallidos = 0
+        for anuncio in anuncios:
+            if anuncio[1] in Vistos:
+                continue
+            if con_resumen(CHATID):
+                # el contacto y la foto solo se buscan si al final el anuncio sale suelto
+                Vistos.add(anuncio[1])
+                encolar_resumen(CHATID, anuncio, palabra_clave, filtro_id)
+                repartir_resumenes(bot)
+            elif not enviar_anuncio(bot, CHATID, anuncio, palabra_clave, filtro_id):
+                # se reintenta en la proxima pasada; los demas anuncios se envian igual
+                fallidos += 1
+
+        # la proxima ventana empieza donde empezo esta descarga, no donde termino el envio; si algun anuncio
+        # fallo, o sigue esperando en un resumen, la ventana y la huella no avanzan para que la proxima pasada
+        # lo vuelva a encontrar si no se llega a enviar
+        if fallidos or en_resumen(filtro_id):
+            cursor = (mas_reciente or ultimo_anuncio, ultimo_run if ultimo_run is not None else inicio, None)
+        else:
+            cursor = (mas_reciente or ultimo_anuncio, inicio, huella)
+        Cursores[filtro_id] = cursor
+        guardar_cursor(filtro_id, cursor[0], cursor[1], cursor[2])
+        time.sleep(0.1)
+    repartir_resumenes(bot)
+
+
+def enviar_anuncio(bot, CHATID, anuncio, palabra_clave, filtro_id):
+    """Envia un anuncio completo al chat y al canal; False si no se pudo abrir su pagina"""
+    url = REVOLICO_URL + str(anuncio[1])
+    titulo = anuncio[2]
+    precio = anuncio[3]
+    descripcion = anuncio[4]
+    fecha = anuncio[5]
+    ubicacion = anuncio[6]
+    foto = anuncio[7]
+    # el mismo anuncio puede coincidir con varios filtros: su contacto solo se busca una vez
+    contacto = obtener_contacto_guardado(url)
+    id_historial = obtener_id_historial(anuncio[1]) if CONTACTO_DIFERIDO and contacto is None else None
+    if contacto is None and id_historial is None:
+        try:
+            with medir('contacto'):
+                contacto = obtener_contacto(url)
+        except resiliencia.CircuitoAbierto:
+            raise
         except Exception as e:
-            print(e)
+            logger.warning('No se pudo abrir el anuncio', extra={'datos': {'url': url, 'error': str(e)[:200]}})
+            return False
+        guardar_contacto(url, *contacto)
+
+    logger.debug('Enviando anuncio', extra={'datos': {'titulo': titulo, 'palabra_clave': palabra_clave}})
+    dt = datetime.now(pytz.timezone('Cuba'))
+    hora = dt.strftime('%Y-%m-%d a las %H:%M:%S')
+
+    info = (
+            "#" + str(palabra_clave) + "\n" + str(titulo) + "\n\n"
+            + "Precio: " + str(precio) + "\n\n\n"
+            + "descripcion: \n" + str(descripcion) + "\n\n\n"
+            + "fecha: " + str(hora) + "\n"
+            + "ubicacion: " + str(ubicacion) + "\n"
+            + (texto_contacto(*contacto) if contacto else CONTACTO_PENDIENTE + "\n\n")
+    )
+
+    boton = InlineKeyboardButton("Ver anuncio", url)
+    markup = InlineKeyboardMarkup([
+        [boton]
+    ] + ([[InlineKeyboardButton("Ver contacto", callback_data='contacto:' + str(id_historial))]]
+         if not contacto else []))
+
+    # print("Esta es la info: "+str(info))
+    src_img = None
+    # la foto tambien sale de la pagina del anuncio: en modo diferido solo se envia el texto
+    if foto != 0 and foto != 'no tiene' and not CONTACTO_DIFERIDO:
+        try:
+            with medir('imagenes'):
+                src_img = obtener_imagenes(url)
+        except resiliencia.CircuitoAbierto:
+            raise
+        except Exception as e:
+            # sin la foto el anuncio se envia como texto
+            logger.warning('No se pudo obtener la imagen', extra={'datos': {'url': url, 'error': str(e)[:200]}})
+    if src_img:
+        ft = open("foto.jpg", "rb")
+        # inf =str(info)+'<a href="'+ src_img +'">&#8205;</a>'
+        with medir('telegram'):
+            bot.send_chat_action(CHATID, action=ChatAction.UPLOAD_PHOTO)
+            # upd.message.reply_text(text=inf, parse_mode="HTML", reply_markup=markup)
+            bot.send_photo(CHATID, photo=ft, caption=info, reply_markup=markup)
+            # -1001598585439
+
+            bot.send_message(
+                chat_id=CANAL_ID,
+                text=info,
+                reply_markup=markup
+            )
+        incrementar('envios', 2)
+        incrementar('llamadas_telegram', 3)
+    else:
+        # chat.send_action(action=ChatAction.TYPING)
+        with medir('telegram'):
+            bot.send_message(CHATID, info, reply_markup=markup)
+            bot.send_message(
+                    chat_id=CANAL_ID,
+                    text=info,
+                    reply_markup=markup
+                )
+        incrementar('envios', 2)
+        incrementar('llamadas_telegram', 2)
+    incrementar('anuncios_enviados')
+
+    Vistos.add(anuncio[1])
+    marcar_visto(anuncio[1], filtro_id)
+    return True
+
+
+def con_resumen(CHATID):
+    return DIGEST_VENTANA > 0 and (not DIGEST_CHATS or str(CHATID) in DIGEST_CHATS)
+
+
+def en_resumen(filtro_id):
+    return any(pendiente[2] == filtro_id for pendientes in Resumenes.values() for pendiente in pendientes['anuncios'])
+
+
+def encolar_resumen(CHATID, anuncio, palabra_clave, filtro_id):
+    pendientes = Resumenes.setdefault(CHATID, {'desde': time.time(), 'anuncios': []})
+    pendientes['anuncios'].append((anuncio, palabra_clave, filtro_id))
+
+
+def repartir_resumenes(bot, forzar=False):
+    """Envia los resumenes que han llegado a DIGEST_MAX anuncios o a DIGEST_VENTANA segundos (todos si forzar)"""
+    ahora = time.time()
+    for CHATID in list(Resumenes):
+        pendientes = Resumenes[CHATID]
+        if not forzar and len(pendientes['anuncios']) < DIGEST_MAX and ahora - pendientes['desde'] < DIGEST_VENTANA:
+            continue
+        del Resumenes[CHATID]
+        anuncios = pendientes['anuncios']
+        if len(anuncios) >= DIGEST_MINIMO:
+            try:
+                enviar_resumen(bot, CHATID, anuncios)
+            except Exception as e:
+                logger.exception(e)
+                # se quitan de Vistos para que la proxima pasada los vuelva a encontrar
+                for anuncio, palabra_clave, filtro_id in anuncios:
+                    Vistos.discard(anuncio[1])
+            continue
+        # poco volumen: cada anuncio sale suelto, con contacto y foto; los que fallan se quedan fuera de Vistos
+        for anuncio, palabra_clave, filtro_id in anuncios:
+            Vistos.discard(anuncio[1])
+            try:
+                if not enviar_anuncio(bot, CHATID, anuncio, palabra_clave, filtro_id):
+                    incrementar('errores', etiqueta='resumen')
+            except Exception as e:
+                incrementar('errores', etiqueta='resumen')
+                logger.exception(e)
+
+
+def enviar_resumen(bot, CHATID, anuncios):
+    """Un solo mensaje (al chat y al canal) con una linea y un boton numerado por anuncio"""
+    dt = datetime.now(pytz.timezone('Cuba'))
+    hora = dt.strftime('%Y-%m-%d a las %H:%M:%S')
+    lineas = [str(len(anuncios)) + " anuncios nuevos\nfecha: " + hora + "\n"]
+    botones = []
+    for numero, (anuncio, palabra_clave, filtro_id) in enumerate(anuncios, 1):
+        datos = [str(dato) for dato in (anuncio[3], anuncio[6]) if dato and dato != 'no tiene']
+        lineas.append(str(numero) + ". #" + str(palabra_clave) + " " + str(anuncio[2])[:80]
+                      + ("\n    " + " - ".join(datos) if datos else ""))
+        botones.append(InlineKeyboardButton(str(numero), REVOLICO_URL + str(anuncio[1])))
+    # limite de longitud de un mensaje de telegram
+    info = "\n".join(lineas)[:4096]
+    markup = InlineKeyboardMarkup([botones[i:i + 5] for i in range(0, len(botones), 5)])
+    with medir('telegram'):
+        bot.send_message(CHATID, info, reply_markup=markup)
+        bot.send_message(chat_id=CANAL_ID, text=info, reply_markup=markup)
+    incrementar('envios', 2)
+    incrementar('llamadas_telegram', 2)
+    incrementar('anuncios_enviados', len(anuncios))
+    incrementar('anuncios_en_resumen', len(anuncios))
+    incrementar('resumenes')
+    # sueltos habrian sido al menos 2 mensajes por anuncio
+    incrementar('llamadas_evitadas', 2 * len(anuncios) - 2)
+    for anuncio, palabra_clave, filtro_id in anuncios:
+        marcar_visto(anuncio[1], filtro_id)
+
+
+def texto_contacto(Contacto, telefono, email):
+    return (
+            "Contacto: " + str(Contacto) + "\n"
+            + "Email: " + str(email) + "\n"
+            + "Telefono: #" + str(telefono) + "\n\n"
+    )
 
 
 botones_filtro_borrar = []
@@ -228,7 +448,6 @@ def departamento(update: Update, context: CallbackContext) -> None:
 
 
 def palabra_clave(update, context):
-    print("estoy dentro de palabra clave")
     query = update.callback_query
     query.answer()
     query.edit_message_text(text="Ejemplos de búsquedas por palabra clave:\n"
@@ -312,9 +531,8 @@ def precio_max(update, context):
 
 
 def received_information(update, context):
-    print("estoy dentro de recived")
     text = update.message.text
-    print(text)
+    logger.debug('Dato del filtro recibido', extra={'datos': {'campo': bt.id, 'valor': text}})
 
     update.message.reply_text('ok.Puedes seguir editando el filtro  o terminar', reply_markup=markup_filtro)
     bt.valor = text
@@ -348,8 +566,6 @@ def done(update, context):
         for filtro in Filtros:
             id = filtro.id
             valor = filtro.valor
-            print("filtro id: ", id)
-            print("filtro valor: ", valor)
 
             if id == "palabra_clave":
                 p_clave_valor = valor
@@ -374,10 +590,8 @@ def done(update, context):
     )
     Filtros.clear()
     userName = update.effective_user['first_name']
-    log_data = "[" + str(userName) + "]: " + str(p_clave_valor) + "\n"
-    with open("log.txt", "a") as log_file:
-        log_file.write(str(log_data))
-        log_file.close()
+    logger.info('Filtro creado', extra={'datos': {'usuario': userName, 'departamento': dep, 'palabra_clave': p_clave_valor,
+                                                  'precio_min': pr_min_valor, 'precio_max': pr_max_valor}})
 
     return ConversationHandler.END
 
@@ -386,34 +600,45 @@ def delete_all(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     eliminar_todos_los_filtros()
+    # sqlite reutiliza los ids: un filtro nuevo no debe heredar el cursor de uno borrado
+    Cursores.clear()
     query.edit_message_text("Se han eliminado todos los filtros")
 
 
 def delete_filter(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     eliminar_filtro(query.data)
+    Cursores.pop(int(query.data), None)
     query.answer()
     botones_filtro_borrar.clear()
     query.edit_message_text("Se ha elimindao satisfactoriamente el filtro")
 
 
 def iniciar_lista_de_trabajo(upd, context):
+    upd.message.reply_text('Se ha iniciado la busqueda automatica , para detenerlo teclee /stop')
+    lanzar_busqueda(upd.message.chat_id, context.bot)
+
+
+def lanzar_busqueda(chat_id, bot):
     stop_threads.clear()
     stop_threads.append(False)
-    upd.message.reply_text('Se ha iniciado la busqueda automatica , para detenerlo teclee /stop')
+    detener_busquedas()
+    guardar_busqueda(chat_id, 'funcionando')
     global hilo_busqueda
-    hilo_busqueda = threading.Thread(target=buscar, args=(upd, context,))
+    hilo_busqueda = threading.Thread(target=buscar, args=(chat_id, bot,))
     hilo_busqueda.start()
 
 
 def parar(upd):
-    print(Hilo_status)
+    logger.debug('Deteniendo la busqueda', extra={'datos': {'estado': Hilo_status[0]}})
     Hilo_status.clear()
     Hilo_status.append("detenido")
     stop_threads.clear()
     stop_threads.append(True)
     hilo_busqueda.join()
-    print('thread killed')
+    detener_busquedas()
+    supervisor.cerrar_todos()
+    logger.info('Busqueda detenida')
     upd.message.reply_text('Stopped!')
 
 
@@ -457,7 +682,6 @@ def stoped(update: Updater, context):
 
 
 def status(update: Updater, context):
-    print(update)
     update.message.reply_text(Hilo_status[0])
     # context.bot.send_message(
     #                             chat_id="-1001598585439",
@@ -538,6 +762,124 @@ def show(update, context):
 
 
 
+def precios(update, context):
+    """Estadisticas de precio de una palabra clave: /precios <palabra clave>"""
+    if autentificar(update, context):
+        if not context.args:
+            update.message.reply_text('Uso: /precios <palabra clave>')
+            return
+        palabra_clave = " ".join(context.args)
+        estadisticas = obtener_estadisticas_precios(palabra_clave)
+        if not estadisticas:
+            update.message.reply_text('Todavia no hay precios para "' + palabra_clave + '"')
+            return
+        mensaje = "Precios de #" + palabra_clave + "\n"
+        for moneda, cantidad, minimo, maximo, suma, cubos in estadisticas:
+            mensaje += (
+                    "\n" + str(moneda) + " (" + str(cantidad) + " anuncios)\n" +
+                    "minimo: " + str(minimo) + "\n" +
+                    "mediana: ~" + str(percentil_cubos(cubos, 0.5)) + "\n" +
+                    "percentil 90: ~" + str(percentil_cubos(cubos, 0.9)) + "\n" +
+                    "maximo: " + str(maximo) + "\n" +
+                    "media: " + str(round(suma / cantidad, 2)) + "\n"
+            )
+        update.message.reply_text(mensaje)
+    else:
+        update.message.reply_text(
+            'Lo siento usted no tiene permiso para acceder a este bot , por favor pongase en contacto con el administrador')
+
+
+def mensaje_historial(consulta, pagina, clave):
+    resultados, hay_mas = buscar_historial(consulta, pagina)
+    if not resultados:
+        return 'No hay anuncios guardados para "' + consulta + '"', None
+    texto = 'Resultados para "' + consulta + '" (pagina ' + str(pagina) + ')\n'
+    botones = []
+    for i, (url, titulo, precio, ubicacion, visto) in enumerate(resultados, start=(pagina - 1) * 5 + 1):
+        dt = datetime.fromtimestamp(visto, pytz.timezone('Cuba'))
+        texto += (
+                "\n" + str(i) + ". " + str(titulo) + "\n" +
+                "Precio: " + str(precio) + "\n" +
+                "ubicacion: " + str(ubicacion) + "\n" +
+                "visto: " + dt.strftime('%Y-%m-%d %H:%M') + "\n"
+        )
+        botones.append([InlineKeyboardButton(str(i) + ". Ver anuncio", REVOLICO_URL + str(url))])
+    if hay_mas:
+        # callback_data tiene un limite de 64 bytes: la consulta se queda en chat_data y solo viaja su clave
+        datos = 'historial:' + clave + ':' + str(pagina + 1)
+        botones.append([InlineKeyboardButton("Mas resultados", callback_data=datos)])
+    return texto, InlineKeyboardMarkup(botones)
+
+
+def historial(update, context):
+    """Busca en los anuncios ya vistos: /historial <texto>"""
+    if autentificar(update, context):
+        if not context.args:
+            update.message.reply_text('Uso: /historial <texto a buscar>')
+            return
+        consulta = " ".join(context.args)
+        consultas = context.chat_data.setdefault('historial', {})
+        clave = secrets.token_hex(4)
+        consultas[clave] = consulta
+        # solo se recuerdan las ultimas busquedas de cada chat
+        for vieja in list(consultas)[:-CONSULTAS_HISTORIAL]:
+            del consultas[vieja]
+        texto, markup = mensaje_historial(consulta, 1, clave)
+        update.message.reply_text(texto, reply_markup=markup)
+    else:
+        update.message.reply_text(
+            'Lo siento usted no tiene permiso para acceder a este bot , por favor pongase en contacto con el administrador')
+
+
+def ver_contacto(update: Update, context: CallbackContext) -> None:
+    """Boton "Ver contacto" de los anuncios enviados en modo diferido: abre la pagina y edita el mensaje"""
+    query = update.callback_query
+    url = obtener_url_historial(int(query.data.split(':', 1)[1]))
+    if url is None:
+        query.answer('Este anuncio ya no esta en el historial')
+        return
+    url = REVOLICO_URL + str(url)
+    contacto = obtener_contacto_guardado(url)
+    if contacto is None:
+        query.answer('Buscando el contacto...')
+        incrementar('contactos_pedidos')
+        try:
+            with medir('contacto'):
+                contacto = obtener_contacto(url)
+        except Exception as e:
+            # el boton sigue en el mensaje: se puede volver a pulsar
+            logger.warning('No se pudo abrir el anuncio', extra={'datos': {'url': url, 'error': str(e)[:200]}})
+            return
+        guardar_contacto(url, *contacto)
+    else:
+        query.answer()
+        incrementar('contactos_cache')
+    mensaje = query.message
+    texto = (mensaje.text or mensaje.caption or "").rstrip("\n")
+    if CONTACTO_PENDIENTE in texto:
+        texto = texto.replace(CONTACTO_PENDIENTE, texto_contacto(*contacto).rstrip("\n"))
+    else:
+        texto += "\n" + texto_contacto(*contacto).rstrip("\n")
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("Ver anuncio", url)]])
+    if mensaje.caption is not None:
+        query.edit_message_caption(caption=texto, reply_markup=markup)
+    else:
+        query.edit_message_text(texto, reply_markup=markup)
+
+
+def historial_pagina(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    _, clave, pagina = query.data.split(':', 2)
+    consulta = context.chat_data.get('historial', {}).get(clave)
+    if consulta is None:
+        # el bot se reinicio o la busqueda es de las mas antiguas
+        query.answer('Esta busqueda ha caducado, repita /historial')
+        return
+    query.answer()
+    texto, markup = mensaje_historial(consulta, int(pagina), clave)
+    query.edit_message_text(texto, reply_markup=markup)
+
+
 def help(update, context):
     """Mostrar la ayuda del bot"""
     if autentificar(update, context):
@@ -554,24 +896,37 @@ def ads_admin(update, context):
     mi_id = 1122914981
     if str(update.message.chat_id) == str(mi_id):
         # sendDocument
-        doc = open('log.txt', 'rb')
-        bot.send_document(mi_id, doc)
+        with open(registro.FICHERO, 'rb') as doc:
+            bot.send_document(mi_id, doc)
+
+
+def stats(update, context):
+    """Metricas del pipeline (solo admin)"""
+    if str(update.message.chat_id) == str(ADMIN_ID):
+        if not HABILITADO[0]:
+            update.message.reply_text('Las metricas estan deshabilitadas, defina METRICAS_PUERTO o METRICAS=1')
+        else:
+            update.message.reply_text(resumen())
+
+
+def perfil(update, context):
+    """Perfila los proximos N ciclos de busqueda y envia el resultado al admin (solo admin)"""
+    if str(update.message.chat_id) == str(ADMIN_ID):
+        ciclos = 1
+        if context.args and context.args[0].isdigit():
+            ciclos = int(context.args[0])
+        perfilador.armar(ciclos)
+        mensaje = 'Se perfilaran los proximos ' + str(ciclos) + ' ciclos de busqueda, el resultado llegara por aqui'
+        if Hilo_status[0] != 'funcionando':
+            mensaje += ' (la busqueda esta detenida, inicie /start_search)'
+        update.message.reply_text(mensaje)
 
 
 def Listener(update, context):
-    print(update)
-    bot = context.bot
-    update_msg = getattr(update, "message", None)  # get info of message
-    msg_id = update_msg.message_id  # get recently message id
-    groupId = update.message.chat_id
     userName = update.effective_user['first_name']
     user_id = update.effective_user['id']  # get user id
     text = update.message.text  # get message sent to the bot
-    logger.info(f"[{user_id}][{userName}]:{text}.")
-    log_data = "[" + str(userName) + "]: " + str(text) + "\n"
-    with open("log.txt", "a") as log_file:
-        log_file.write(str(log_data))
-        log_file.close()
+    logger.info('Mensaje recibido', extra={'datos': {'usuario_id': user_id, 'usuario': userName, 'texto': text}})
 
 
 def error(update, context):
@@ -579,9 +934,6 @@ def error(update, context):
     err = context.error
     logger.warning('Update "%s" caused error "%s"', update, err)
     time.sleep(5)
-    with open("log.txt", "a") as log_file:
-        log_file.write("Error:" + str(err))
-        log_file.close()
     update.message.reply_text(err)
 
 
@@ -589,26 +941,98 @@ def not_comand(update, context):
     pass
 
 
-def main():
-    """Start the bot."""
-    updater = Updater(TOKEN, use_context=True)
+def restaurar_estado(bot):
+    """Recupera usuarios, cursores y anuncios vistos de la DB y reanuda las busquedas que estaban activas"""
+    crear_tabla_filtros()
+    crear_tablas_estado()
+    crear_tablas_historial()
+    for user in Users_id:
+        guardar_usuario(user)
+    for user in obtener_usuarios():
+        if user not in Users_id:
+            Users_id.append(user)
+    Cursores.update(obtener_cursores())
+    Vistos.update(obtener_vistos())
+    logger.info('Estado restaurado', extra={'datos': {'usuarios': len(Users_id), 'cursores': len(Cursores),
+                                                      'vistos': len(Vistos)}})
+
+    # solo hay un hilo de busqueda: se reanuda para el ultimo chat que la tenia activa
+    chats = obtener_busquedas_activas()
+    if chats:
+        chat_id = chats[-1]
+        Hilo_status.clear()
+        Hilo_status.append('funcionando')
+        lanzar_busqueda(chat_id, bot)
+        try:
+            bot.send_message(chat_id, 'Se ha reanudado la busqueda automatica tras un reinicio, para detenerla teclee /stop')
+        except Exception as e:
+            logger.exception(e)
+
+
+def contar_update(update, context):
+    incrementar('updates', etiqueta=Modo_bot[0], nombre_etiqueta='modo')
+
+
+def iniciar_webhook(updater):
+    """Arranca el servidor del webhook; devuelve False sin arrancar nada si no se puede usar"""
+    if not WEBHOOK_URL:
+        logger.warning('BOT_MODO=webhook sin WEBHOOK_URL ni HEROKU_APP_NAME')
+        return False
+    url = WEBHOOK_URL.rstrip('/') + '/' + WEBHOOK_SECRETO
+    # start_webhook se queda esperando para siempre si no puede escuchar en el puerto o si falla set_webhook,
+    # por eso se comprueban las dos cosas antes
+    try:
+        with socket.socket() as prueba:
+            prueba.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            prueba.bind((WEBHOOK_HOST, WEBHOOK_PUERTO))
+        updater.bot.set_webhook(url)
+    except Exception as e:
+        logger.warning('No se pudo preparar el webhook', extra={'datos': {'error': str(e), 'puerto': WEBHOOK_PUERTO}})
+        return False
+    updater.start_webhook(listen=WEBHOOK_HOST, port=WEBHOOK_PUERTO, url_path=WEBHOOK_SECRETO, webhook_url=url)
+    return True
+
+
+def arrancar(updater):
+    """Empieza a recibir updates segun BOT_MODO; si el webhook no se puede usar se recurre a polling"""
+    if BOT_MODO == 'webhook' and iniciar_webhook(updater):
+        Modo_bot[0] = 'webhook'
+    else:
+        # start_polling borra el webhook que hubiera registrado
+        updater.start_polling()
+        Modo_bot[0] = 'polling'
+    logger.info('Recibiendo updates', extra={'datos': {'modo': Modo_bot[0], 'url': WEBHOOK_URL,
+                                                      'puerto': WEBHOOK_PUERTO}})
+
+
+def construir_updater(token=None):
+    """Updater con todos los handlers registrados, sin arrancar"""
+    updater = Updater(token or TOKEN, use_context=True, base_url=TELEGRAM_API_URL, workers=BOT_WORKERS)
 
     # Get the dispatcher to register handlers
 
     dp = updater.dispatcher
 
+    dp.add_handler(TypeHandler(Update, contar_update), group=-1)
+
     # Comandos
-    dp.add_handler(CommandHandler("start", start))
+    # los que solo leen se atienden en el pool de BOT_WORKERS hilos; los que cambian filtros o la busqueda,
+    # en orden en el hilo del dispatcher
+    dp.add_handler(CommandHandler("start", start, run_async=True))
     dp.add_handler(CommandHandler("start_search", start_search, pass_chat_data=True))
     dp.add_handler(CommandHandler("stop", stoped))
     dp.add_handler(CommandHandler("delete", delete))
-    dp.add_handler(CommandHandler("show", show))
-    dp.add_handler(CommandHandler("test", test))
-    dp.add_handler(CommandHandler("help", help))
+    dp.add_handler(CommandHandler("show", show, run_async=True))
+    dp.add_handler(CommandHandler("test", test, run_async=True))
+    dp.add_handler(CommandHandler("help", help, run_async=True))
+    dp.add_handler(CommandHandler("precios", precios, run_async=True))
+    dp.add_handler(CommandHandler("historial", historial, run_async=True))
     dp.add_handler(CommandHandler("ads_admin", ads_admin))
-    dp.add_handler(CommandHandler("status", status))
+    dp.add_handler(CommandHandler("stats", stats, run_async=True))
+    dp.add_handler(CommandHandler("perfil", perfil))
+    dp.add_handler(CommandHandler("status", status, run_async=True))
     # dp.add_handler(CommandHandler("delete_user", delete_user))
-    dp.add_handler(CommandHandler("show_user", show_user))
+    dp.add_handler(CommandHandler("show_user", show_user, run_async=True))
 
     dp.add_handler(ConversationHandler(
         entry_points=[
@@ -651,6 +1075,9 @@ def main():
     dp.add_handler(CallbackQueryHandler(cancel, pattern='Cancelar'))
     # dp.add_handler(CallbackQueryHandler(cancel_user, pattern='Cancelar_user'))
     dp.add_handler(CallbackQueryHandler(delete_all, pattern='borrar todos'))
+    dp.add_handler(CallbackQueryHandler(historial_pagina, pattern='^historial:', run_async=True))
+    # abre un navegador: en el pool para no frenar al resto de updates
+    dp.add_handler(CallbackQueryHandler(ver_contacto, pattern='^contacto:', run_async=True))
     dp.add_handler(CallbackQueryHandler(delete_filter))
     dp.add_handler(MessageHandler(Filters.text, Listener))
     dp.add_handler(MessageHandler(Filters.photo | Filters.audio | Filters.voice |
@@ -659,14 +1086,15 @@ def main():
 
     # log all errors
     dp.add_error_handler(error)
+    return updater
 
-    updater.start_polling()
-
-    # PORT = int(os.environ.get("PORT", "8443"))
-    # HEROKU_APP_NAME = os.environ.get("HEROKU_APP_NAME")
-    # updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN)
-    # updater.bot.set_webhook("https://{}.herokuapp.com/{}".format(HEROKU_APP_NAME, TOKEN))
 
+def main():
+    """Start the bot."""
+    iniciar_servidor()
+    updater = construir_updater()
+    restaurar_estado(updater.bot)
+    arrancar(updater)
     updater.idle()
 
 
@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Las metricas solo se recogen si se define METRICAS_PUERTO (o METRICAS=1 sin servidor http)
+PUERTO = os.environ.get('METRICAS_PUERTO')
+HABILITADO = [PUERTO is not None or os.environ.get('METRICAS') == '1']
+
+# limites (en segundos) de los histogramas de latencia
+LIMITES = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_contadores = {}
+_histogramas = {}
+# nombre de la etiqueta de cada contador en /metrics (por defecto 'etapa')
+_nombres_etiqueta = {}
+_NULO = nullcontext()
+
+
+class _Span:
+    __slots__ = ('etapa', 'inicio')
+
+    def __init__(self, etapa):
+        self.etapa = etapa
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        observar(self.etapa, time.perf_counter() - self.inicio)
+        # las excepciones que ya conto quien las lanzo (reintentos agotados, circuito abierto) no cuentan otra vez
+        if tipo is not None and not getattr(valor, 'metrica_contada', False):
+            incrementar('errores', etiqueta=self.etapa)
+        return False
+
+
+def medir(etapa):
+    """Mide la duracion de una etapa del pipeline (no hace nada si las metricas estan deshabilitadas)"""
+    if not HABILITADO[0]:
+        return _NULO
+    return _Span(etapa)
+
+
+def incrementar(nombre, valor=1, etiqueta=None, nombre_etiqueta='etapa'):
+    """Suma `valor` al contador; `etiqueta` sale en /metrics como {nombre_etiqueta="etiqueta"}"""
+    if not HABILITADO[0]:
+        return
+    clave = (nombre, etiqueta)
+    with _lock:
+        _contadores[clave] = _contadores.get(clave, 0) + valor
+        if etiqueta is not None:
+            _nombres_etiqueta[nombre] = nombre_etiqueta
+
+
+def observar(etapa, segundos):
+    if not HABILITADO[0]:
+        return
+    with _lock:
+        histograma = _histogramas.get(etapa)
+        if histograma is None:
+            # un cubo por limite + el cubo +Inf, la suma y el total
+            histograma = _histogramas[etapa] = [0] * (len(LIMITES) + 1) + [0.0, 0]
+        for i, limite in enumerate(LIMITES):
+            if segundos <= limite:
+                histograma[i] += 1
+                break
+        else:
+            histograma[len(LIMITES)] += 1
+        histograma[-2] += segundos
+        histograma[-1] += 1
+
+
+def contador(nombre, etiqueta=None):
+    with _lock:
+        return _contadores.get((nombre, etiqueta), 0)
+
+
+def instantanea():
+    """Copia de los contadores y histogramas actuales"""
+    with _lock:
+        return dict(_contadores), {etapa: list(h) for etapa, h in _histogramas.items()}
+
+
+def reiniciar():
+    with _lock:
+        _contadores.clear()
+        _histogramas.clear()
+        _nombres_etiqueta.clear()
+
+
+def percentil(histograma, p):
+    """Estimacion del percentil p (0-1) a partir de los cubos de un histograma"""
+    total = histograma[-1]
+    if not total:
+        return 0.0
+    objetivo = p * total
+    acumulado = 0
+    for i, limite in enumerate(LIMITES):
+        acumulado += histograma[i]
+        if acumulado >= objetivo:
+            return limite
+    return float('inf')
+
+
+def formato_prometheus():
+    contadores, histogramas = instantanea()
+    with _lock:
+        nombres_etiqueta = dict(_nombres_etiqueta)
+    lineas = []
+    anterior = None
+    for (nombre, etiqueta), valor in sorted(contadores.items(), key=lambda c: (c[0][0], str(c[0][1]))):
+        if nombre != anterior:
+            lineas.append('# TYPE revolico_%s_total counter' % nombre)
+            anterior = nombre
+        if etiqueta is None:
+            lineas.append('revolico_%s_total %s' % (nombre, valor))
+        else:
+            lineas.append('revolico_%s_total{%s="%s"} %s' % (nombre, nombres_etiqueta.get(nombre, 'etapa'), etiqueta,
+                                                           valor))
+    if histogramas:
+        lineas.append('# TYPE revolico_etapa_segundos histogram')
+    for etapa, histograma in sorted(histogramas.items()):
+        acumulado = 0
+        for i, limite in enumerate(LIMITES):
+            acumulado += histograma[i]
+            lineas.append('revolico_etapa_segundos_bucket{etapa="%s",le="%s"} %s' % (etapa, limite, acumulado))
+        lineas.append('revolico_etapa_segundos_bucket{etapa="%s",le="+Inf"} %s' % (etapa, histograma[-1]))
+        lineas.append('revolico_etapa_segundos_sum{etapa="%s"} %s' % (etapa, round(histograma[-2], 6)))
+        lineas.append('revolico_etapa_segundos_count{etapa="%s"} %s' % (etapa, histograma[-1]))
+    return "\n".join(lineas) + "\n"
+
+
+def resumen():
+    """Texto corto para el comando /stats"""
+    contadores, histogramas = instantanea()
+    lineas = []
+    for (nombre, etiqueta), valor in sorted(contadores.items(), key=lambda c: (c[0][0], str(c[0][1]))):
+        if etiqueta is None:
+            lineas.append(nombre + ": " + str(valor))
+        else:
+            lineas.append(nombre + "[" + etiqueta + "]: " + str(valor))
+    listados = contadores.get(('listados', None))
+    if listados:
+        sin_cambios = contadores.get(('listados_sin_cambios', None), 0)
+        lineas.append("listados sin cambios: %.1f%%" % (100.0 * sin_cambios / listados))
+    enviados = contadores.get(('anuncios_enviados', None))
+    if enviados:
+        llamadas = contadores.get(('llamadas_telegram', None), 0)
+        evitadas = contadores.get(('llamadas_evitadas', None), 0)
+        lineas.append("llamadas a telegram por anuncio: %.2f (ahorradas por los resumenes: %.2f)"
+                      % (llamadas / enviados, evitadas / enviados))
+    if histogramas:
+        lineas.append("")
+        lineas.append("etapa: n / media / p50 / p95 (s)")
+    for etapa, histograma in sorted(histogramas.items()):
+        media = histograma[-2] / histograma[-1] if histograma[-1] else 0
+        lineas.append("%s: %s / %.3f / %s / %s" % (etapa, histograma[-1], media,
+                                                  percentil(histograma, 0.5), percentil(histograma, 0.95)))
+    return "\n".join(lineas) if lineas else "Todavia no hay metricas"
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        cuerpo = formato_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+def iniciar_servidor(puerto=None, host=None):
+    """Expone /metrics en formato Prometheus en un hilo aparte"""
+    puerto = puerto or PUERTO
+    host = host or os.environ.get('METRICAS_HOST', '127.0.0.1')
+    if puerto is None:
+        return None
+    HABILITADO[0] = True
+    servidor = ThreadingHTTPServer((host, int(puerto)), _Manejador)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    return servidor
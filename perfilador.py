@@ -0,0 +1,100 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import tracemalloc
+import zipfile
+from datetime import datetime
+
+PERFILES_DIR = os.environ.get('PERFILES_DIR', 'perfiles')
+
+_lock = threading.Lock()
+# 'trazando': si tracemalloc lo arranco el perfilador (y por tanto debe pararlo)
+_estado = {'pendientes': 0, 'ciclos': 0, 'perfil': None, 'memoria_inicial': None, 'listo': None, 'trazando': False}
+
+
+def armar(ciclos):
+    """Perfila los proximos `ciclos` ciclos de buscar"""
+    with _lock:
+        _estado['pendientes'] = max(1, int(ciclos))
+        _estado['ciclos'] = 0
+
+
+def recoger():
+    """Devuelve (y olvida) la ruta del ultimo perfil terminado, o None"""
+    with _lock:
+        fichero = _estado['listo']
+        _estado['listo'] = None
+        return fichero
+
+
+class perfilar_ciclo:
+    """Envuelve un ciclo de buscar: si el perfilador esta armado activa cProfile y tracemalloc"""
+
+    def __enter__(self):
+        if not _estado['pendientes']:
+            return self
+        if _estado['perfil'] is None:
+            _estado['perfil'] = cProfile.Profile()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                _estado['trazando'] = True
+            _estado['memoria_inicial'] = tracemalloc.take_snapshot()
+        _estado['perfil'].enable()
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        perfil = _estado['perfil']
+        if perfil is None:
+            return False
+        perfil.disable()
+        with _lock:
+            _estado['ciclos'] += 1
+            _estado['pendientes'] -= 1
+            terminado = _estado['pendientes'] <= 0
+        if terminado:
+            fichero = _guardar(perfil, _estado['memoria_inicial'], _estado['ciclos'], _estado['trazando'])
+            _estado['trazando'] = False
+            _estado['perfil'] = None
+            _estado['memoria_inicial'] = None
+            with _lock:
+                _estado['pendientes'] = 0
+                _estado['listo'] = fichero
+        return False
+
+
+def _guardar(perfil, memoria_inicial, ciclos, parar_traza):
+    os.makedirs(PERFILES_DIR, exist_ok=True)
+    nombre = 'perfil_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.zip'
+    fichero = os.path.join(PERFILES_DIR, nombre)
+
+    texto = io.StringIO()
+    texto.write("Ciclos perfilados: " + str(ciclos) + "\n\n")
+    estadisticas = pstats.Stats(perfil, stream=texto)
+    estadisticas.sort_stats('cumulative').print_stats(60)
+    estadisticas.sort_stats('tottime').print_stats(30)
+
+    memoria = io.StringIO()
+    if tracemalloc.is_tracing():
+        actual = tracemalloc.take_snapshot()
+        actual_kb, pico_kb = [x // 1024 for x in tracemalloc.get_traced_memory()]
+        if parar_traza:
+            tracemalloc.stop()
+        memoria.write("Memoria trazada: " + str(actual_kb) + " KB (pico " + str(pico_kb) + " KB)\n\n")
+        memoria.write("Top 30 asignaciones por linea:\n")
+        for estadistica in actual.statistics('lineno')[:30]:
+            memoria.write(str(estadistica) + "\n")
+        if memoria_inicial is not None:
+            memoria.write("\nTop 30 diferencias desde el inicio del perfil:\n")
+            for estadistica in actual.compare_to(memoria_inicial, 'lineno')[:30]:
+                memoria.write(str(estadistica) + "\n")
+
+    ruta_pstats = fichero + '.pstats'
+    perfil.dump_stats(ruta_pstats)
+    with zipfile.ZipFile(fichero, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.write(ruta_pstats, 'cprofile.pstats')
+        zf.writestr('cprofile.txt', texto.getvalue())
+        zf.writestr('tracemalloc.txt', memoria.getvalue())
+    os.remove(ruta_pstats)
+    return fichero
@@ -0,0 +1,53 @@
+import math
+import re
+
+# cada cubo del histograma cubre un 10% de precio: el error de los percentiles es de +-5%
+BASE_CUBOS = 1.1
+
+MONEDAS = {
+    'usd': 'USD', 'us$': 'USD', 'dolar': 'USD', 'dolares': 'USD', 'dólar': 'USD', 'dólares': 'USD', '$': 'USD',
+    'cup': 'CUP', 'mn': 'CUP', 'pesos': 'CUP', 'cuc': 'CUC', 'mlc': 'MLC', 'eur': 'EUR', 'euro': 'EUR',
+    'euros': 'EUR', '€': 'EUR',
+}
+_NUMERO = re.compile(r'\d[\d.,\s]*')
+_MONEDA = re.compile(r'us\$|\$|€|[a-záéíóú]+', re.IGNORECASE)
+
+
+def parsear_precio(texto):
+    """'1,500 CUP' -> (1500.0, 'CUP'); (None, None) si no hay precio"""
+    if not texto or texto == 'no tiene':
+        return None, None
+    encontrado = _NUMERO.search(texto)
+    if not encontrado:
+        return None, None
+    numero = re.sub(r'\s', '', encontrado.group()).rstrip('.,')
+    # "1.500" / "1,500" son miles; "12.50" / "12,50" son decimales
+    partes = re.split(r'[.,]', numero)
+    if len(partes) > 1 and len(partes[-1]) != 3:
+        monto = float("".join(partes[:-1]) + "." + partes[-1])
+    else:
+        monto = float("".join(partes))
+    moneda = None
+    for palabra in _MONEDA.findall(texto):
+        moneda = MONEDAS.get(palabra.lower())
+        if moneda:
+            break
+    return monto, moneda or 'USD'
+
+
+def cubo(monto):
+    return int(math.floor(math.log(max(monto, 1)) / math.log(BASE_CUBOS)))
+
+
+def percentil_cubos(cubos, p):
+    """Estimacion del percentil p (0-1) a partir del histograma {cubo: cantidad}"""
+    total = sum(cubos.values())
+    if not total:
+        return None
+    objetivo = p * total
+    acumulado = 0
+    for indice in sorted(cubos, key=int):
+        acumulado += cubos[indice]
+        if acumulado >= objetivo:
+            return round(BASE_CUBOS ** (int(indice) + 0.5), 2)
+    return None
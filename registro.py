@@ -0,0 +1,58 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+FICHERO = os.environ.get('LOG_FICHERO', 'log.txt')
+NIVEL = os.environ.get('LOG_NIVEL', 'INFO')
+# ej. LOG_NIVELES="scraper=DEBUG,db=WARNING,telegram=WARNING"
+NIVELES = os.environ.get('LOG_NIVELES', '')
+MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 1024 * 1024))
+COPIAS = int(os.environ.get('LOG_COPIAS', 3))
+
+_oyente = []
+
+
+class FormatoEstructurado(logging.Formatter):
+    """Una linea por registro: fecha nivel modulo mensaje clave=valor ..."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        linea = super().format(record)
+        datos = getattr(record, 'datos', None)
+        if datos:
+            linea += " " + " ".join(str(clave) + "=" + repr(valor) for clave, valor in datos.items())
+        return linea
+
+
+def configurar():
+    """Envia todos los registros por una cola a un hilo que escribe en consola y en el fichero rotativo"""
+    if _oyente:
+        return
+    formato = FormatoEstructurado()
+    fichero = logging.handlers.RotatingFileHandler(FICHERO, maxBytes=MAX_BYTES, backupCount=COPIAS,
+                                                   encoding='utf-8')
+    fichero.setFormatter(formato)
+    consola = logging.StreamHandler(sys.stdout)
+    consola.setFormatter(formato)
+
+    cola = queue.SimpleQueue()
+    oyente = logging.handlers.QueueListener(cola, fichero, consola, respect_handler_level=True)
+    oyente.start()
+    _oyente.append(oyente)
+    atexit.register(oyente.stop)
+
+    raiz = logging.getLogger()
+    for manejador in list(raiz.handlers):
+        raiz.removeHandler(manejador)
+    raiz.addHandler(logging.handlers.QueueHandler(cola))
+    raiz.setLevel(NIVEL.upper())
+
+    for par in NIVELES.split(','):
+        if '=' in par:
+            modulo, nivel = par.split('=', 1)
+            logging.getLogger(modulo.strip()).setLevel(nivel.strip().upper())
@@ -0,0 +1,161 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from selenium.webdriver.remote.remote_connection import RemoteConnection
+
+from metricas import incrementar
+import supervisor
+
+logger = logging.getLogger(__name__)
+
+# conexion de las descargas http; carga de una pagina en chrome (y lectura http); scripts de selenium
+TIMEOUT_CONEXION = float(os.environ.get('TIMEOUT_CONEXION_S', 10))
+TIMEOUT_CARGA = float(os.environ.get('TIMEOUT_CARGA_S', 30))
+TIMEOUT_SCRIPT = float(os.environ.get('TIMEOUT_SCRIPT_S', 10))
+# intentos extra de cada descarga antes de dar el error por bueno
+REINTENTOS = int(os.environ.get('REINTENTOS', 2))
+# si una pagina de anuncio tarda mas que esto se pide otra vez en otro navegador y gana la primera
+# (0 = desactivado; necesita NAVEGADORES_MAX > 1)
+COBERTURA = float(os.environ.get('COBERTURA_S', 0))
+# fallos seguidos que abren el circuito, y pausa inicial / maxima antes de probar otra vez
+CIRCUITO_FALLOS = int(os.environ.get('CIRCUITO_FALLOS', 5))
+CIRCUITO_PAUSA = float(os.environ.get('CIRCUITO_PAUSA_S', 60))
+CIRCUITO_PAUSA_MAX = float(os.environ.get('CIRCUITO_PAUSA_MAX_S', 600))
+
+# ningun comando a chromedriver puede tardar mas que una carga completa
+RemoteConnection.set_timeout(TIMEOUT_CONEXION + TIMEOUT_CARGA + TIMEOUT_SCRIPT)
+
+
+class CircuitoAbierto(Exception):
+    # no es un fallo de descarga: medir() no lo cuenta en errores
+    metrica_contada = True
+
+
+class Circuito:
+    """cerrado -> (CIRCUITO_FALLOS fallos seguidos) -> abierto -> (pausa) -> semiabierto -> cerrado o abierto"""
+
+    def __init__(self, fallos, pausa, pausa_max):
+        self.fallos_max = fallos
+        self.pausa_inicial = pausa
+        self.pausa_max = pausa_max
+        self.estado = 'cerrado'
+        self.fallos = 0
+        self.pausa = pausa
+        self.abierto_hasta = 0
+        self._lock = threading.Lock()
+
+    def restante(self):
+        return max(0, self.abierto_hasta - time.time())
+
+    def permite(self):
+        """False mientras dura la pausa; al terminar deja pasar peticiones de prueba"""
+        with self._lock:
+            if self.estado == 'abierto':
+                if time.time() < self.abierto_hasta:
+                    return False
+                self.estado = 'semiabierto'
+                logger.info('Circuito semiabierto, probando el sitio')
+            return True
+
+    def exito(self):
+        with self._lock:
+            if self.estado != 'cerrado':
+                logger.info('Circuito cerrado, el sitio responde', extra={'datos': {'estado_anterior': self.estado}})
+            self.estado = 'cerrado'
+            self.fallos = 0
+            self.pausa = self.pausa_inicial
+
+    def fallo(self):
+        with self._lock:
+            self.fallos += 1
+            if self.estado == 'semiabierto':
+                # la prueba fallo: otra pausa, el doble de larga
+                self.pausa = min(self.pausa * 2, self.pausa_max)
+            elif self.estado == 'abierto' or self.fallos < self.fallos_max:
+                return
+            self.estado = 'abierto'
+            self.abierto_hasta = time.time() + self.pausa
+        incrementar('circuito_abierto')
+        logger.warning('Circuito abierto, se pausa el scraping',
+                       extra={'datos': {'fallos': self.fallos, 'pausa_s': self.pausa}})
+
+
+CIRCUITO = Circuito(CIRCUITO_FALLOS, CIRCUITO_PAUSA, CIRCUITO_PAUSA_MAX)
+# los listados llevan un circuito por filtro: una busqueda que siempre falla no para a las demas
+_circuitos_listado = {}
+
+_ejecutor = []
+_lock = threading.Lock()
+
+
+def circuito_listado(filtro_id):
+    with _lock:
+        circuito = _circuitos_listado.get(filtro_id)
+        if circuito is None:
+            circuito = _circuitos_listado[filtro_id] = Circuito(CIRCUITO_FALLOS, CIRCUITO_PAUSA, CIRCUITO_PAUSA_MAX)
+        return circuito
+
+
+def configurar_navegador(driver):
+    driver.set_page_load_timeout(TIMEOUT_CARGA)
+    driver.set_script_timeout(TIMEOUT_SCRIPT)
+
+
+def con_reintentos(funcion, *args, etapa=None, circuito=CIRCUITO, **kwargs):
+    """Llama a `funcion` hasta REINTENTOS veces mas si falla, con espera exponencial.
+
+    Cada intento cuenta para `circuito`; con el circuito abierto lanza CircuitoAbierto sin intentar nada.
+    """
+    for intento in range(REINTENTOS + 1):
+        if circuito is not None and not circuito.permite():
+            raise CircuitoAbierto('Circuito abierto durante ' + str(round(circuito.restante())) + 's mas')
+        try:
+            resultado = funcion(*args, **kwargs)
+        except Exception as e:
+            if circuito is not None:
+                circuito.fallo()
+            if intento == REINTENTOS:
+                incrementar('errores', etiqueta=etapa or 'descarga')
+                # ya contado: los medir() que lo envuelven no lo cuentan otra vez
+                e.metrica_contada = True
+                raise
+            incrementar('reintentos', etiqueta=etapa)
+            logger.warning('Reintentando', extra={'datos': {'etapa': etapa, 'intento': intento + 1,
+                                                           'error': str(e)[:200]}})
+            time.sleep(min(0.5 * 2 ** intento, 8) * random.uniform(0.5, 1.5))
+        else:
+            if circuito is not None:
+                circuito.exito()
+            return resultado
+
+
+def con_cobertura(funcion, *args, etapa=None, **kwargs):
+    """con_reintentos, y si no ha terminado en COBERTURA segundos se lanza una copia; gana la primera que acaba bien"""
+    if not COBERTURA or supervisor.NAVEGADORES_MAX < 2:
+        return con_reintentos(funcion, *args, etapa=etapa, **kwargs)
+    with _lock:
+        if not _ejecutor:
+            _ejecutor.append(ThreadPoolExecutor(max_workers=supervisor.NAVEGADORES_MAX * 2))
+    ejecutor = _ejecutor[0]
+    primera = ejecutor.submit(con_reintentos, funcion, *args, etapa=etapa, **kwargs)
+    hechas, _ = wait([primera], timeout=COBERTURA)
+    if hechas:
+        return primera.result()
+    incrementar('coberturas', etiqueta=etapa)
+    segunda = ejecutor.submit(con_reintentos, funcion, *args, etapa=etapa, **kwargs)
+    pendientes = {primera, segunda}
+    error = None
+    while pendientes:
+        hechas, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+        for futura in hechas:
+            if futura.exception() is None:
+                if futura is segunda:
+                    incrementar('coberturas_ganadas', etiqueta=etapa)
+                # la otra sigue hasta su timeout en segundo plano; su resultado se descarta
+                return futura.result()
+            error = futura.exception()
+    raise error
@@ -1,27 +1,90 @@
 from selenium import webdriver
+import hashlib
+import logging
 import os
+import shutil
 import time, requests
 import unicodedata
 from bs4 import BeautifulSoup
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.support.select import Select
 
 from db import crear_tabla_anuncio
 from db import insertar_anuncio
+from db import archivar_anuncios
+from fechas import en_ventana, ventana_desde
+from metricas import medir, incrementar
+from supervisor import pagina
+import supervisor
+import archivo
+import resiliencia
+import transporte
+
+logger = logging.getLogger(__name__)
+
+# se puede cambiar para apuntar el scraper a un servidor local (ver benchmark.py)
+REVOLICO_URL = os.environ.get("REVOLICO_URL", "https://www.revolico.com")
+
+# 'completo': chrome con ventana maximizada (como siempre) | 'ligero': headless, viewport pequeno y sin recursos estaticos
+PERFIL_NAVEGADOR = os.environ.get("NAVEGADOR_PERFIL", "completo")
+# recursos que el perfil ligero no descarga (el html y los scripts de revolico si se cargan)
+URLS_BLOQUEADAS = [
+    "*.css", "*.woff", "*.woff2", "*.ttf", "*.otf", "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.mp4", "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*googlesyndication.com*",
+    "*adservice.google.*", "*facebook.net*", "*facebook.com/tr*", "*hotjar.com*",
+] + [url for url in os.environ.get("NAVEGADOR_BLOQUEAR", "").split(",") if url]
+
+# hrefs de los anuncios del listado, en orden: es la huella que se compara entre pasadas
+JS_URLS_LISTADO = """
+    var ul = document.querySelector('ul');
+    if (!ul) return [];
+    return Array.from(ul.querySelectorAll('li')).map(function (li) {
+        var a = li.querySelector('a');
+        return a ? a.getAttribute('href') : '';
+    });
+"""
+# chrome no hace fallar driver.get por errores de red (proxy caido...), muestra su pagina de error
+JS_ERROR_RED = "return document.body !== null && document.body.classList.contains('neterror');"
 
 
 def Navegador():
     options = webdriver.ChromeOptions()
-    options.add_argument("start-maximized")
+    if PERFIL_NAVEGADOR == 'ligero':
+        options.add_argument("--headless")
+        options.add_argument("--window-size=1280,900")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--disable-extensions")
+        options.add_argument("--disable-dev-shm-usage")
+        # driver.get vuelve en DOMContentLoaded sin esperar imagenes ni iframes
+        options.set_capability("pageLoadStrategy", "eager")
+    else:
+        options.add_argument("start-maximized")
     options.add_argument('blink-settings=imagesEnabled=false')
     options.add_argument("--no-sandbox")
     options.add_experimental_option("excludeSwitches", ["enable-automation"])
     options.add_experimental_option('useAutomationExtension', False)
     options.add_argument("--disable-blink-features=AutomationControlled")
-
-    
-
-    driver = webdriver.Chrome(options=options, executable_path=os.environ.get("CHROMEDRIVER_PATH"))
+    # perfil propio y marcado: supervisor.py reconoce por el los procesos huerfanos de este bot
+    perfil = supervisor.directorio_perfil()
+    options.add_argument("--user-data-dir=" + perfil)
+    # todo el navegador sale por la misma salida del pool mientras viva
+    salida = transporte.elegir()
+    if salida.proxy_navegador:
+        options.add_argument("--proxy-server=" + salida.proxy_navegador)
+        # sin esto chrome no usa el proxy para localhost (ver benchmark.py --proxies)
+        options.add_argument("--proxy-bypass-list=<-loopback>")
+
+    try:
+        with medir('navegador'):
+            driver = webdriver.Chrome(options=options, executable_path=os.environ.get("CHROMEDRIVER_PATH"))
+    except BaseException:
+        shutil.rmtree(perfil, ignore_errors=True)
+        raise
+    driver.directorio_perfil = perfil
+    incrementar('navegadores_lanzados')
+    driver.salida = salida
+    resiliencia.configurar_navegador(driver)
 
     driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
         "source": """
@@ -32,67 +95,104 @@ def Navegador():
     })
 
     driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-    driver.execute_cdp_cmd('Network.setUserAgentOverride', {
-        "userAgent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.53 Safari/537.36'})
-    print(driver.execute_script("return navigator.userAgent;"))
+    # el user agent rota en cada navegador aunque la salida sea la misma
+    driver.execute_cdp_cmd('Network.setUserAgentOverride', {"userAgent": transporte.user_agent()})
+    if PERFIL_NAVEGADOR == 'ligero':
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {"urls": URLS_BLOQUEADAS})
+    logger.debug('Navegador listo', extra={'datos': {'user_agent': driver.execute_script("return navigator.userAgent;"),
+                                                     'salida': salida.nombre}})
     return driver
 
 
+def cargar(driver, url):
+    """driver.get que cuenta para la salud de la salida del navegador"""
+    with medir('carga_pagina'), transporte.medir_salida(getattr(driver, 'salida', None)):
+        driver.get(url)
+        if driver.execute_script(JS_ERROR_RED):
+            raise WebDriverException('Error de red cargando ' + url)
+
+
 def scroll(driver):
     iter = 1
+    # una pagina que no deja de crecer no puede alargar el scroll mas que una carga completa
+    limite = time.time() + resiliencia.TIMEOUT_CARGA
     while True:
-        print('scroll')
         scrollHeight = driver.execute_script("return document.documentElement.scrollHeight")
         Height = 250 * iter
         driver.execute_script("window.scrollTo(0, " + str(Height) + ");")
-        if Height > scrollHeight:
-            print('End of page')
+        if Height > scrollHeight or time.time() > limite:
+            logger.debug('Fin de la pagina', extra={'datos': {'scrolls': iter}})
             break
         time.sleep(1)
         iter += 1
 
 
-def obtener_imagenes(url):
-    driver = Navegador()
-    driver.get(url)
-    driver.implicitly_wait(0.3)
+def descargar_detalle(url):
+    """html de la pagina de un anuncio"""
+    incrementar('detalles')
+    with pagina(Navegador) as driver:
+        cargar(driver, url)
+        driver.implicitly_wait(0.3)
 
-    scroll(driver)
+        with medir('scroll'):
+            scroll(driver)
 
-    # todo el html del body
-    body = driver.execute_script("return document.body")
-    source = body.get_attribute('innerHTML')
-    soup = BeautifulSoup(source, "lxml")
+        # todo el html del body
+        body = driver.execute_script("return document.body")
+        source = body.get_attribute('innerHTML')
+    archivo.guardar(url, 'detalle', source)
+    return source
 
-    driver.quit()
 
+def obtener_imagenes(url):
+    source = resiliencia.con_cobertura(descargar_detalle, url, etapa='detalle')
+    with medir('parseo'):
+        url = extraer_imagen(source)
+    if url:
+        with medir('imagen'):
+            my_img = resiliencia.con_reintentos(descargar_imagen, url, etapa='imagen', circuito=None)
+        if not my_img.ok:
+            # 404, 410...: no hay foto y no vale la pena reintentar
+            logger.debug('Imagen no disponible', extra={'datos': {'url': url, 'estado': my_img.status_code}})
+            return None
+        logger.debug('Obteniendo imagen', extra={'datos': {'url': url}})
+        open('foto.jpg', 'wb').write(my_img.content)
+
+        return url
+
+
+def descargar_imagen(url):
+    """transporte.get que lanza con 429 y 5xx: asi se reintenta y, si sigue fallando, el anuncio sale sin foto"""
+    respuesta = transporte.get(url)
+    if respuesta.status_code == 429 or respuesta.status_code >= 500:
+        respuesta.raise_for_status()
+    return respuesta
+
+
+def extraer_imagen(source):
+    """url de la ultima imagen de la pagina de un anuncio, o None"""
+    soup = BeautifulSoup(source, "lxml")
+    url = None
     # obteniendo las url de las imagenes
     contenedor_imagenes = soup.find('div', {'class': 'Detail__ImagesWrapper-sc-1irc1un-8 hImDlm'})
     if contenedor_imagenes:
         imagenes = contenedor_imagenes.find_all('div')
-        if imagenes:
-            for imagen in imagenes:
-                if imagen.find('a').get('href') is not None:
-                    url = imagen.find('a').get('href')
-            my_img = requests.get(url)
-            print("obteniendo imagen desde : ",url)
-            open('foto.jpg', 'wb').write(my_img.content)
-
-            return url
+        for imagen in imagenes:
+            if imagen.find('a').get('href') is not None:
+                url = imagen.find('a').get('href')
+    return url
 
 
 def obtener_contacto(url):
-    driver = Navegador()
-    driver.get(url)
-    driver.implicitly_wait(0.3)
+    source = resiliencia.con_cobertura(descargar_detalle, url, etapa='detalle')
+    with medir('parseo'):
+        return extraer_contacto(source)
 
-    scroll(driver)
 
-    # todo el html del body
-    body = driver.execute_script("return document.body")
-    source = body.get_attribute('innerHTML')
+def extraer_contacto(source):
+    """(contacto, telefono, email) de la pagina de un anuncio"""
     soup = BeautifulSoup(source, "lxml")
-
     if soup.find('div', {'data-cy': 'adName'}) is not None:
         contacto = soup.find('div', {'data-cy': 'adName'}).get_text()
     else:
@@ -106,112 +206,125 @@ def obtener_contacto(url):
     else:
         email = "no tiene"
 
-    driver.quit()
     return contacto, telefono, email
 
 
 def obeteniendo_html(departamento, palabra_clave, precio_min=None, precio_max=None, provincia=None, municipio=None,
                      fotos=None):
-    driver = Navegador()
-
     if departamento is not None:
-        url = "https://www.revolico.com/" + str(departamento) + "/search.html?q=" + str(palabra_clave)+"&order=date"
-        print("Accediendo a : ",url)
+        url = REVOLICO_URL + "/" + str(departamento) + "/search.html?q=" + str(palabra_clave)+"&order=date"
     else:
-        url = "https://www.revolico.com/search.html?q=" + str(palabra_clave)
-
-    print("Departamento", departamento)
-    print("palabra clave:", palabra_clave)
-
-    driver.get(url)
-    driver.maximize_window()
-    driver.implicitly_wait(0.1)
-
-    if precio_min is not None:
-        cuadro_precio_min = driver.find_element_by_xpath(
-            "/html/body/div/div/main/div/div/div[2]/form/div/div[1]/div[2]/input[1]")
-        cuadro_precio_min.send_keys(precio_min)
-        time.sleep(0.1)
-    if precio_max is not None:
-        cuadro_precio_max = driver.find_element_by_xpath(
-            "/html/body/div/div/main/div/div/div[2]/form/div/div[1]/div[2]/input[2]")
-        cuadro_precio_max.send_keys(precio_max)
-        time.sleep(0.1)
-    if provincia is not None:
-        cuadro_provincia = Select(driver.find_element_by_xpath(
-            "/html/body/div/div/main/div/div/div[2]/form/div/div[2]/div[1]/div/div[1]/select"))
-        cuadro_provincia.select_by_visible_text(provincia)
-        time.sleep(0.1)
-    # if municipio is not None:
-    #     print('poniendo municipio')
-    #     cuadro_municipio = Select(driver.find_element_by_xpath(
-    #         "/html/body/div/div/main/div/div/div[2]/form/div/div[2]/div[1]/div/div[2]/select"))
-    #     cuadro_municipio.select_by_visible_text(municipio)
-    #     time.sleep(1)
-    # if fotos is not None and fotos == True:
-    #     print('poniendo fotos')
-    #     cuadro_fotos = driver.find_element_by_xpath(
-    #         "/html/body/div/div/main/div/div/div[2]/form/div/div[2]/div[2]/label/input")
-    #     cuadro_fotos.click()
-    #     time.sleep(1)
-    boton_buscar_secundario = driver.find_element_by_xpath(
-        "/html/body/div/div/main/div/div/div[2]/form/div/div[3]/button")
-    boton_buscar_secundario.click()
-
-    scroll(driver)
-
-    # todo el html del body
-    body = driver.execute_script("return document.body")
-    source = body.get_attribute('innerHTML')
-    soup = BeautifulSoup(source, "lxml")
-
-    driver.quit()
-    return soup
+        url = REVOLICO_URL + "/search.html?q=" + str(palabra_clave)
+
+    logger.debug('Accediendo al listado',
+                 extra={'datos': {'url': url, 'departamento': departamento, 'palabra_clave': palabra_clave}})
+
+    with pagina(Navegador) as driver:
+        cargar(driver, url)
+        if PERFIL_NAVEGADOR != 'ligero':
+            driver.maximize_window()
+        driver.implicitly_wait(0.1)
+
+        if precio_min is not None:
+            cuadro_precio_min = driver.find_element_by_xpath(
+                "/html/body/div/div/main/div/div/div[2]/form/div/div[1]/div[2]/input[1]")
+            cuadro_precio_min.send_keys(precio_min)
+            time.sleep(0.1)
+        if precio_max is not None:
+            cuadro_precio_max = driver.find_element_by_xpath(
+                "/html/body/div/div/main/div/div/div[2]/form/div/div[1]/div[2]/input[2]")
+            cuadro_precio_max.send_keys(precio_max)
+            time.sleep(0.1)
+        if provincia is not None:
+            cuadro_provincia = Select(driver.find_element_by_xpath(
+                "/html/body/div/div/main/div/div/div[2]/form/div/div[2]/div[1]/div/div[1]/select"))
+            cuadro_provincia.select_by_visible_text(provincia)
+            time.sleep(0.1)
+        # if municipio is not None:
+        #     print('poniendo municipio')
+        #     cuadro_municipio = Select(driver.find_element_by_xpath(
+        #         "/html/body/div/div/main/div/div/div[2]/form/div/div[2]/div[1]/div/div[2]/select"))
+        #     cuadro_municipio.select_by_visible_text(municipio)
+        #     time.sleep(1)
+        # if fotos is not None and fotos == True:
+        #     print('poniendo fotos')
+        #     cuadro_fotos = driver.find_element_by_xpath(
+        #         "/html/body/div/div/main/div/div/div[2]/form/div/div[2]/div[2]/label/input")
+        #     cuadro_fotos.click()
+        #     time.sleep(1)
+        boton_buscar_secundario = driver.find_element_by_xpath(
+            "/html/body/div/div/main/div/div/div[2]/form/div/div[3]/button")
+        with medir('busqueda'):
+            boton_buscar_secundario.click()
+
+        with medir('scroll'):
+            scroll(driver)
+
+        # todo el html del body
+        body = driver.execute_script("return document.body")
+        source = body.get_attribute('innerHTML')
+        urls = driver.execute_script(JS_URLS_LISTADO)
+    archivo.guardar(url, 'listado', source, departamento, palabra_clave)
+    return source, urls
+
+
+def huella_listado(urls):
+    """sha1 de las urls del listado en orden; None si no hay anuncios (no se puede comparar)"""
+    if not urls:
+        return None
+    return hashlib.sha1("\n".join(url or '' for url in urls).encode()).hexdigest()
 
 
 def get_main_anuncios(departamento, palabra_clave, precio_min=None, precio_max=None, provincia=None, municipio=None,
-                      fotos=None):
-    contenido_web = obeteniendo_html(departamento, palabra_clave, precio_min, precio_max, provincia, municipio, fotos)
-    # print(contenido_web)
-    anuncios = contenido_web.find('ul')
-    if anuncios != None:
-        articulos = anuncios.find_all('li')
-
+                      fotos=None, vistos=None, desde=None, huella_anterior=None, circuito=resiliencia.CIRCUITO):
+    """Guarda en la tabla anuncios los anuncios nuevos que coinciden y devuelve (url del mas reciente, huella).
+
+    Solo se aceptan anuncios publicados despues de `desde` (UTC; por defecto el ultimo minuto) y se ignoran los
+    que esten en `vistos` (ya enviados). Todos los del listado van al historial.
+    Si la huella del listado es igual a `huella_anterior` no se parsea ni se toca la DB: la tabla anuncios queda
+    como estaba y quien llama debe ignorarla.
+    """
+    if desde is None:
+        desde = ventana_desde(None)
+    mas_reciente = None
+    listado = []
+    source, urls = resiliencia.con_reintentos(obeteniendo_html, departamento, palabra_clave, precio_min, precio_max,
+                                              provincia, municipio, fotos, etapa='listado', circuito=circuito)
+    huella = huella_listado(urls)
+    incrementar('listados')
+    if huella is not None and huella == huella_anterior:
+        incrementar('listados_sin_cambios')
+        logger.debug('Listado sin cambios', extra={'datos': {'palabra_clave': palabra_clave, 'huella': huella}})
+        return next((url for url in urls if url), None), huella
+
+    try:
+        with medir('parseo'):
+            anuncios = extraer_anuncios(source, palabra_clave)
+    except Exception as e:
+        incrementar('errores', etiqueta='extraccion')
+        logger.exception(e)
+        return None, None
+    if anuncios is not None:
         try:
             crear_tabla_anuncio()
-            for articulo in articulos:
-                if articulo.find('a').get('href') is not None:
-                    url = articulo.find('a').get('href')
-                else:
-                    url = 'no tiene'
-                if articulo.find('span', {'data-cy': 'adTitle'}) is not None:
-                    titulo = articulo.find('span', {'data-cy': 'adTitle'}).get_text()
-                else:
-                    titulo = 'no tiene'
-                if articulo.find('span', {'data-cy': 'adPrice'}) is not None:
-                    precio = articulo.find('span', {'data-cy': 'adPrice'}).get_text()
-                else:
-                    precio = 'no tiene'
-                if articulo.find('span', {'class': 'List__Description-sc-1oa0tfl-3 ljbzeb'}) is not None:
-                    descripcion = articulo.find('span', {'class': 'List__Description-sc-1oa0tfl-3 ljbzeb'}).get_text()
-                else:
-                    descripcion = 'no tiene'
-                if articulo.find('time', {'class': 'List__AdMoment-sc-1oa0tfl-8 eWSYKR'}) is not None:
-                    fecha = articulo.find('time', {'class': 'List__AdMoment-sc-1oa0tfl-8 eWSYKR'}).get_text()
-                else:
-                    fecha = 'no tiene'
-                if articulo.find('span', {'class': 'List__Location-sc-1oa0tfl-10 IKJXO'}) is not None:
-                    ubicacion = articulo.find('span', {'class': 'List__Location-sc-1oa0tfl-10 IKJXO'}).get_text()
-                else:
-                    ubicacion = 'no tiene'
-                if articulo.find('a', {'class': 'List__StyledTooltip-sc-1oa0tfl-11 ADRO'}) is not None:
-                    foto = articulo.find('a', {'class': 'List__StyledTooltip-sc-1oa0tfl-11 ADRO'}).get_text()
-                else:
-                    foto = 'no tiene'
-                
-
-
-                if str(fecha).find('segundos') != -1 and str(url) != 'no tiene': 
+            for anuncio in anuncios:
+                incrementar('anuncios_vistos')
+                url = anuncio['url']
+                titulo = anuncio['titulo']
+                precio = anuncio['precio']
+                descripcion = anuncio['descripcion']
+                fecha = anuncio['fecha']
+                ubicacion = anuncio['ubicacion']
+                foto = anuncio['foto']
+
+                if mas_reciente is None and url != 'no tiene':
+                    mas_reciente = url
+                if url != 'no tiene':
+                    listado.append(anuncio)
+                if vistos is not None and url in vistos:
+                    continue
+
+                if en_ventana(fecha, desde) and str(url) != 'no tiene':
                     # descrip_normalize=unicodedata.normalize('NFKD', descripcion).encode('ASCII', 'ignore').lower()
                     # titulo_normalize=unicodedata.normalize('NFKD', titulo).encode('ASCII', 'ignore').lower()
                     # palabra_clave_normalize =unicodedata.normalize('NFKD', palabra_clave).encode('ASCII', 'ignore').lower()
@@ -221,10 +334,9 @@ def get_main_anuncios(departamento, palabra_clave, precio_min=None, precio_max=N
                     palabra_clave_normalize =palabra_clave.lower()
                     
 
-                    print("Este es el normalize de la palabra_clave: "+palabra_clave_normalize)
-
                     if str(descrip_normalize).find(palabra_clave_normalize)!=-1 or str(titulo_normalize).find(palabra_clave_normalize)!=-1:
-                        print('Este anuncio va a DB: '+titulo+"\n")
+                        logger.debug('Este anuncio va a DB', extra={'datos': {'titulo': titulo, 'url': url}})
+                        incrementar('anuncios_coincidentes')
                         insertar_anuncio(
                                         url=url, 
                                         titulo=titulo, 
@@ -235,9 +347,59 @@ def get_main_anuncios(departamento, palabra_clave, precio_min=None, precio_max=N
                                         foto=foto
                                      )
 
+            archivar_anuncios(departamento, palabra_clave, listado)
         except Exception as e:
-            print(e)
+            incrementar('errores', etiqueta='extraccion')
+            logger.exception(e)
+            # la proxima pasada tiene que volver a procesar este listado
+            huella = None
     else:
-        print('No esta devolviendo anuncios')
-
-
+        logger.warning('No esta devolviendo anuncios', extra={'datos': {'palabra_clave': palabra_clave}})
+    return mas_reciente, huella
+
+
+def extraer_anuncios(source, palabra_clave):
+    """Anuncios (dicts) del html de un listado, en orden; None si la pagina no tiene lista de anuncios.
+
+    No toca el navegador ni la DB: lo usan get_main_anuncios y el reparseo del archivo (archivo.py).
+    """
+    contenido_web = BeautifulSoup(source, "lxml")
+    lista = contenido_web.find('ul')
+    if lista is None:
+        return None
+    anuncios = []
+    for articulo in lista.find_all('li'):
+        if articulo.find('a').get('href') is not None:
+            url = articulo.find('a').get('href')
+        else:
+            url = 'no tiene'
+        if articulo.find('span', {'data-cy': 'adTitle'}) is not None:
+            titulo = articulo.find('span', {'data-cy': 'adTitle'}).get_text()
+        else:
+            titulo = 'no tiene'
+        if articulo.find('span', {'data-cy': 'adPrice'}) is not None:
+            precio = articulo.find('span', {'data-cy': 'adPrice'}).get_text()
+        else:
+            precio = 'no tiene'
+        if articulo.find('span', {'class': 'List__Description-sc-1oa0tfl-3 ljbzeb'}) is not None:
+            descripcion = articulo.find('span', {'class': 'List__Description-sc-1oa0tfl-3 ljbzeb'}).get_text()
+        else:
+            descripcion = 'no tiene'
+        if articulo.find('time', {'class': 'List__AdMoment-sc-1oa0tfl-8 eWSYKR'}) is not None:
+            fecha = articulo.find('time', {'class': 'List__AdMoment-sc-1oa0tfl-8 eWSYKR'}).get_text()
+        else:
+            fecha = 'no tiene'
+        if articulo.find('span', {'class': 'List__Location-sc-1oa0tfl-10 IKJXO'}) is not None:
+            ubicacion = articulo.find('span', {'class': 'List__Location-sc-1oa0tfl-10 IKJXO'}).get_text()
+        else:
+            ubicacion = 'no tiene'
+        if articulo.find('a', {'class': 'List__StyledTooltip-sc-1oa0tfl-11 ADRO'}) is not None:
+            foto = articulo.find('a', {'class': 'List__StyledTooltip-sc-1oa0tfl-11 ADRO'}).get_text()
+        else:
+            foto = 'no tiene'
+        anuncios.append({
+            'url': url, 'titulo': titulo, 'precio': precio, 'descripcion': descripcion, 'fecha': fecha,
+            'ubicacion': ubicacion, 'foto': foto,
+            'coincide': palabra_clave.lower() in descripcion.lower() or palabra_clave.lower() in titulo.lower(),
+        })
+    return anuncios
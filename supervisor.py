@@ -0,0 +1,278 @@
+import atexit
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+from metricas import incrementar
+
+logger = logging.getLogger(__name__)
+
+# un navegador se recicla al llegar a MAX_PAGINAS paginas o si su arbol de procesos pasa de MAX_RSS_MB
+MAX_PAGINAS = int(os.environ.get('NAVEGADOR_MAX_PAGINAS', 50))
+MAX_RSS_MB = int(os.environ.get('NAVEGADOR_MAX_RSS_MB', 600))
+# cuantos navegadores pueden estar abiertos a la vez
+NAVEGADORES_MAX = int(os.environ.get('NAVEGADORES_MAX', 1))
+# cada cuanto se buscan procesos de chrome/chromedriver huerfanos
+INTERVALO_LIMPIEZA = int(os.environ.get('NAVEGADOR_LIMPIEZA_S', 300))
+
+NOMBRES_NAVEGADOR = ('chromedriver', 'chrome', 'google-chrome', 'chromium', 'chromium-browser', 'chrome_crashpad')
+
+# va en el --user-data-dir de cada chrome que lanza este proceso: asi se reconocen sus huerfanos
+MARCA = 'revolico_bot_' + str(os.getpid()) + '_'
+
+_condicion = threading.Condition()
+_libres = []
+_abiertas = []
+_creando = [0]
+# mientras se buscan huerfanos no se arranca ningun navegador
+_limpiando = [False]
+_limpiador = []
+# (pid, create_time) de todos los procesos vistos en los arboles de nuestros navegadores
+_propios = set()
+
+
+class _Instancia:
+    def __init__(self, driver):
+        self.driver = driver
+        self.paginas = 0
+        self.creada = time.time()
+        try:
+            self.pid = driver.service.process.pid
+        except AttributeError:
+            self.pid = None
+
+    def procesos(self):
+        """chromedriver y todos los procesos de chrome que cuelgan de el"""
+        if self.pid is None:
+            return []
+        try:
+            raiz = psutil.Process(self.pid)
+            procesos = [raiz] + raiz.children(recursive=True)
+        except psutil.Error:
+            return []
+        for proceso in procesos:
+            try:
+                _propios.add((proceso.pid, proceso.create_time()))
+            except psutil.Error:
+                pass
+        return procesos
+
+    def rss_mb(self):
+        total = 0
+        for proceso in self.procesos():
+            try:
+                total += proceso.memory_info().rss
+            except psutil.Error:
+                pass
+        return total / (1024 * 1024)
+
+
+@contextmanager
+def pagina(fabrica):
+    """Presta un navegador (creandolo con `fabrica` si hace falta) y garantiza que se cierre si algo falla"""
+    _iniciar_limpiador()
+    instancia = _tomar(fabrica)
+    try:
+        yield instancia.driver
+    except BaseException:
+        # el estado del navegador es desconocido: no se reutiliza
+        _cerrar(instancia, 'error')
+        raise
+    instancia.paginas += 1
+    if instancia.paginas >= MAX_PAGINAS:
+        _cerrar(instancia, 'paginas')
+    elif MAX_RSS_MB and instancia.rss_mb() > MAX_RSS_MB:
+        _cerrar(instancia, 'memoria')
+    elif getattr(instancia.driver, 'salida', None) is not None and not instancia.driver.salida.disponible():
+        # su proxy salio de la rotacion: el proximo navegador saldra por otro
+        _cerrar(instancia, 'salida')
+    else:
+        with _condicion:
+            _libres.append(instancia)
+            _condicion.notify()
+
+
+def _tomar(fabrica):
+    with _condicion:
+        while not _libres and (_limpiando[0] or len(_abiertas) + _creando[0] >= NAVEGADORES_MAX):
+            _condicion.wait()
+        if _libres:
+            return _libres.pop()
+        _creando[0] += 1
+    try:
+        instancia = _Instancia(fabrica())
+    except BaseException:
+        with _condicion:
+            _creando[0] -= 1
+            _condicion.notify()
+        # si chromedriver arranco pero chrome no, quedan procesos sin dueno
+        limpiar_huerfanos()
+        raise
+    with _condicion:
+        _creando[0] -= 1
+        _abiertas.append(instancia)
+    return instancia
+
+
+def directorio_perfil():
+    """Carpeta temporal para el --user-data-dir de un chrome nuevo; se borra al cerrarlo"""
+    return tempfile.mkdtemp(prefix=MARCA)
+
+
+def _propio(proceso):
+    """Si el proceso salio de un navegador de este bot (y no es un chrome del usuario)"""
+    try:
+        if (proceso.pid, proceso.create_time()) in _propios:
+            return True
+        return any(MARCA in argumento for argumento in proceso.cmdline())
+    except psutil.Error:
+        return False
+
+
+def _vivo(proceso):
+    # un hijo de chrome puede terminar entre is_running() y status()
+    try:
+        return proceso.is_running() and proceso.status() != psutil.STATUS_ZOMBIE
+    except psutil.Error:
+        return False
+
+
+def _cerrar(instancia, motivo):
+    try:
+        procesos = instancia.procesos()
+        try:
+            instancia.driver.quit()
+        except Exception as e:
+            logger.warning('Fallo driver.quit, se matan los procesos', extra={'datos': {'error': str(e)}})
+        vivos = [p for p in procesos if _vivo(p)]
+        for proceso in vivos:
+            try:
+                proceso.terminate()
+            except psutil.Error:
+                pass
+        _, vivos = psutil.wait_procs(vivos, timeout=5)
+        for proceso in vivos:
+            try:
+                proceso.kill()
+            except psutil.Error:
+                pass
+    finally:
+        directorio = getattr(instancia.driver, 'directorio_perfil', None)
+        if directorio:
+            shutil.rmtree(directorio, ignore_errors=True)
+        # pase lo que pase el hueco se libera; si no, _tomar esperaria para siempre
+        with _condicion:
+            if instancia in _abiertas:
+                _abiertas.remove(instancia)
+            if instancia in _libres:
+                _libres.remove(instancia)
+            _condicion.notify()
+    incrementar('navegadores_reciclados', etiqueta=motivo, nombre_etiqueta='motivo')
+    logger.debug('Navegador cerrado', extra={'datos': {'motivo': motivo, 'paginas': instancia.paginas}})
+
+
+def cerrar_todos():
+    # se sacan de _libres antes de cerrarlos para que nadie los tome a medio cerrar
+    with _condicion:
+        libres = list(_libres)
+        del _libres[:]
+    for instancia in libres:
+        _cerrar(instancia, 'parada')
+
+
+def limpiar_huerfanos():
+    """Mata procesos de chrome/chromedriver que ya no pertenecen a ningun navegador abierto y recoge los zombies"""
+    with _condicion:
+        if _creando[0]:
+            # un navegador a medio arrancar todavia no esta en _abiertas: sus procesos parecerian huerfanos
+            return 0
+        _limpiando[0] = True
+        instancias = list(_abiertas)
+    try:
+        conocidos = set()
+        for instancia in instancias:
+            conocidos.update(p.pid for p in instancia.procesos())
+
+        propio = psutil.Process()
+        huerfanos = []
+        for hijo in propio.children(recursive=True):
+            try:
+                if hijo.status() == psutil.STATUS_ZOMBIE:
+                    if hijo.ppid() == propio.pid:
+                        hijo.wait(timeout=0)
+                    continue
+                if hijo.pid not in conocidos and hijo.name().startswith(NOMBRES_NAVEGADOR):
+                    huerfanos.append(hijo)
+            except (psutil.Error, psutil.TimeoutExpired):
+                pass
+        # chrome reasignado a init cuando su chromedriver murio: solo si se puede atar a este bot, para no
+        # matar los chrome del usuario en la misma maquina
+        usuario = propio.uids().real
+        inicio = propio.create_time()
+        for proceso in psutil.process_iter(['name', 'ppid', 'uids', 'create_time']):
+            try:
+                if (proceso.info['ppid'] == 1 and proceso.info['uids'].real == usuario
+                        and proceso.info['create_time'] >= inicio and proceso.pid not in conocidos
+                        and (proceso.info['name'] or '').startswith(NOMBRES_NAVEGADOR) and _propio(proceso)):
+                    huerfanos.append(proceso)
+            except psutil.Error:
+                pass
+        # se olvidan los procesos que ya no existen
+        for pid, creado in list(_propios):
+            try:
+                if psutil.Process(pid).create_time() == creado:
+                    continue
+            except psutil.Error:
+                pass
+            _propios.discard((pid, creado))
+
+        for proceso in huerfanos:
+            try:
+                proceso.kill()
+            except psutil.Error:
+                pass
+        psutil.wait_procs(huerfanos, timeout=5)
+        if huerfanos:
+            incrementar('procesos_huerfanos', len(huerfanos))
+            logger.warning('Procesos de navegador huerfanos eliminados', extra={'datos': {'procesos': len(huerfanos)}})
+        return len(huerfanos)
+    finally:
+        with _condicion:
+            _limpiando[0] = False
+            _condicion.notify_all()
+
+
+def _vigilar():
+    while True:
+        time.sleep(INTERVALO_LIMPIEZA)
+        try:
+            with _condicion:
+                libres = list(_libres)
+            for instancia in libres:
+                if MAX_RSS_MB and instancia.rss_mb() > MAX_RSS_MB:
+                    with _condicion:
+                        if instancia not in _libres:
+                            continue
+                        _libres.remove(instancia)
+                    _cerrar(instancia, 'memoria')
+            limpiar_huerfanos()
+        except Exception as e:
+            logger.exception(e)
+
+
+def _iniciar_limpiador():
+    if _limpiador:
+        return
+    with _condicion:
+        if _limpiador:
+            return
+        hilo = threading.Thread(target=_vigilar, daemon=True)
+        _limpiador.append(hilo)
+    hilo.start()
+    atexit.register(cerrar_todos)
@@ -0,0 +1,67 @@
+"""Formatos de fecha de revolico que entiende fechas.parsear_fecha.
+
+    python -m pytest -q test_fechas.py
+"""
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from fechas import ZONA, parsear_fecha
+
+# martes 15 de marzo de 2022, 14:00 en cuba (ya en horario de verano, UTC-4)
+AHORA = datetime(2022, 3, 15, 18, 0, tzinfo=timezone.utc)
+
+
+def cuba(anio, mes, dia, horas, minutos, segundos=59):
+    return ZONA.localize(datetime(anio, mes, dia, horas, minutos, segundos)).astimezone(timezone.utc)
+
+
+CASOS = [
+    # relativas
+    ('ahora', AHORA),
+    ('hace instantes', AHORA),
+    ('hace 10 segundos', AHORA - timedelta(seconds=10)),
+    ('hace un minuto', AHORA - timedelta(minutes=1)),
+    ('hace 5 minutos', AHORA - timedelta(minutes=5)),
+    ('hace 2 horas', AHORA - timedelta(hours=2)),
+    ('Hace 3 días', AHORA - timedelta(days=3)),
+    ('hace una semana', AHORA - timedelta(weeks=1)),
+    # hoy / ayer, con y sin a.m./p.m.
+    ('hoy 20:00', AHORA),
+    ('hoy 1:15', cuba(2022, 3, 15, 13, 15)),
+    ('hoy 10:30', cuba(2022, 3, 15, 10, 30)),
+    ('hoy 1:45 p.m.', cuba(2022, 3, 15, 13, 45)),
+    ('hoy 3:45 pm', AHORA),
+    ('hoy 9:05 am', cuba(2022, 3, 15, 9, 5)),
+    ('ayer 3:45 pm', cuba(2022, 3, 14, 15, 45)),
+    ('ayer 3:45 a.m.', cuba(2022, 3, 14, 3, 45)),
+    ('ayer 3:45 a. m.', cuba(2022, 3, 14, 3, 45)),
+    ('ayer 12:10 am', cuba(2022, 3, 14, 0, 10)),
+    ('ayer 12:10 pm', cuba(2022, 3, 14, 12, 10)),
+    ('ayer 3:45', cuba(2022, 3, 14, 15, 45)),
+    ('ayer 20:00', cuba(2022, 3, 14, 20, 0)),
+    ('ayer', cuba(2022, 3, 14, 23, 59)),
+    # absolutas
+    ('12/03/2022', cuba(2022, 3, 12, 23, 59)),
+    ('12-03-22 8:05', cuba(2022, 3, 12, 20, 5)),
+    ('12/03/2022 8:05 am', cuba(2022, 3, 12, 8, 5)),
+    ('12 de marzo', cuba(2022, 3, 12, 23, 59)),
+    ('12 mar. 2021', cuba(2021, 3, 12, 23, 59)),
+    ('20 de diciembre', cuba(2021, 12, 20, 23, 59)),
+    # sin fecha
+    ('no tiene', None),
+    ('', None),
+    ('precio a convenir', None),
+    ('hoy 25:00', None),
+    ('31/02/2022', None),
+]
+
+
+class TestParsearFecha(unittest.TestCase):
+    def test_formatos(self):
+        for texto, esperado in CASOS:
+            with self.subTest(texto=texto):
+                self.assertEqual(parsear_fecha(texto, AHORA), esperado)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""Pool de salidas contra proxies locales de reenvio (los de benchmark.py), sin navegador.
+
+    python -m pytest -q test_transporte.py
+"""
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler
+
+import transporte
+from benchmark import ManejadorProxy, levantar
+
+
+class ManejadorDestino(BaseHTTPRequestHandler):
+    """Responde 200 y apunta el user agent de cada peticion"""
+    user_agents = []
+
+    def do_GET(self):
+        self.user_agents.append(self.headers.get('User-Agent'))
+        cuerpo = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTransporte(unittest.TestCase):
+    def setUp(self):
+        ManejadorDestino.user_agents.clear()
+        ManejadorProxy.peticiones.clear()
+        ManejadorProxy.rotos.clear()
+        self.servidores = []
+        self.destino = self.levantar(ManejadorDestino)[1] + '/foto.jpg'
+
+    def tearDown(self):
+        for servidor in self.servidores:
+            servidor.shutdown()
+            servidor.server_close()
+        transporte.configurar()
+
+    def levantar(self, manejador):
+        servidor, url = levantar(manejador)
+        self.servidores.append(servidor)
+        return servidor, url
+
+    def test_proxy_roto_pierde_en_la_puntuacion(self):
+        bueno, url_bueno = self.levantar(ManejadorProxy)
+        roto, url_roto = self.levantar(ManejadorProxy)
+        ManejadorProxy.rotos.add(roto.server_address[1])
+        salida_buena, salida_rota = transporte.configurar([url_bueno, url_roto])
+
+        respuestas = [transporte.get(self.destino) for _ in range(30)]
+
+        self.assertLess(salida_buena.puntuacion(), salida_rota.puntuacion())
+        self.assertEqual(salida_buena.error, 0)
+        # en cuanto falla una vez la mejor de dos siempre es la buena
+        fallidas = sum(1 for respuesta in respuestas if respuesta.status_code == 502)
+        self.assertEqual(ManejadorProxy.peticiones.get(roto.server_address[1], 0), fallidas)
+        self.assertLessEqual(fallidas, 2)
+        self.assertEqual(len(ManejadorDestino.user_agents), 30 - fallidas)
+
+    def test_proxy_roto_sale_de_la_rotacion(self):
+        roto, url_roto = self.levantar(ManejadorProxy)
+        ManejadorProxy.rotos.add(roto.server_address[1])
+        salida_rota, = transporte.configurar([url_roto])
+
+        for _ in range(transporte.USOS_MINIMOS):
+            self.assertEqual(transporte.get(self.destino).status_code, 502)
+
+        self.assertFalse(salida_rota.disponible())
+        self.assertEqual(transporte.estado()[0]['disponible'], False)
+        self.assertGreater(salida_rota.fuera_hasta, time.time() + transporte.ENFRIAMIENTO / 2)
+
+    def test_user_agent_rota_sin_proxies(self):
+        transporte.configurar([], ['UA-1', 'UA-2', 'UA-3'])
+
+        for _ in range(6):
+            transporte.get(self.destino)
+
+        self.assertEqual(len(transporte.estado()), 1)
+        self.assertEqual(set(ManejadorDestino.user_agents), {'UA-1', 'UA-2', 'UA-3'})
+        self.assertEqual(ManejadorDestino.user_agents[:3], ManejadorDestino.user_agents[3:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+from metricas import incrementar
+from resiliencia import TIMEOUT_CONEXION, TIMEOUT_CARGA
+
+logger = logging.getLogger(__name__)
+
+# proxies separados por coma, ej. "http://10.0.0.2:3128,socks5://10.0.0.3:1080"; sin proxies se sale directo
+PROXIES = [proxy.strip() for proxy in os.environ.get('PROXIES', '').split(',') if proxy.strip()]
+# los user agents llevan comas, asi que se separan con |
+USER_AGENTS = [ua.strip() for ua in os.environ.get('USER_AGENTS', '').split('|') if ua.strip()] or [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.53 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.93 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.93 Safari/537.36',
+]
+# peso de la ultima medida en las medias moviles de latencia y errores
+ALFA = float(os.environ.get('TRANSPORTE_ALFA', 0.3))
+# una salida con mas errores que esto (media movil, 0-1) sale de la rotacion durante ENFRIAMIENTO segundos
+ERROR_MAX = float(os.environ.get('TRANSPORTE_ERROR_MAX', 0.5))
+ENFRIAMIENTO = int(os.environ.get('TRANSPORTE_ENFRIAMIENTO_S', 300))
+# peticiones minimas antes de juzgar una salida
+USOS_MINIMOS = 3
+
+
+class Salida:
+    """Un proxy (o la conexion directa) con su sesion http y su salud"""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        if proxy:
+            partes = urlparse(proxy)
+            self.nombre = partes.hostname + ':' + str(partes.port)
+            # chrome no acepta usuario y clave en --proxy-server
+            self.proxy_navegador = partes.scheme + '://' + self.nombre
+        else:
+            self.nombre = 'directo'
+            self.proxy_navegador = None
+        self.latencia = None
+        self.error = 0.0
+        self.usos = 0
+        self.fuera_hasta = 0
+        self.sesion = requests.Session()
+        if proxy:
+            self.sesion.proxies = {'http': proxy, 'https': proxy}
+
+    def disponible(self, ahora=None):
+        return (ahora or time.time()) >= self.fuera_hasta
+
+    def puntuacion(self):
+        """Menor es mejor: latencia media penalizada por la tasa de errores"""
+        latencia = self.latencia if self.latencia is not None else _latencia_referencia()
+        return latencia * (1 + 4 * self.error)
+
+    def registrar(self, exito, segundos):
+        with _lock:
+            self.usos += 1
+            self.error = ALFA * (0 if exito else 1) + (1 - ALFA) * self.error
+            if exito:
+                self.latencia = segundos if self.latencia is None else ALFA * segundos + (1 - ALFA) * self.latencia
+            if self.usos >= USOS_MINIMOS and self.error > ERROR_MAX and self.disponible():
+                self.fuera_hasta = time.time() + ENFRIAMIENTO
+                # al volver queda a prueba: un par de fallos mas y sale otra vez
+                self.error = ERROR_MAX / 2
+                expulsada = True
+            else:
+                expulsada = False
+        incrementar('peticiones_salida', etiqueta=self.nombre, nombre_etiqueta='salida')
+        if not exito:
+            incrementar('errores_salida', etiqueta=self.nombre, nombre_etiqueta='salida')
+        if expulsada:
+            incrementar('salidas_fuera', etiqueta=self.nombre, nombre_etiqueta='salida')
+            logger.warning('Salida fuera de rotacion', extra={'datos': {'salida': self.nombre,
+                                                                         'enfriamiento_s': ENFRIAMIENTO}})
+
+    def estado(self):
+        return {'salida': self.nombre, 'usos': self.usos, 'error': round(self.error, 3),
+                'latencia_s': round(self.latencia, 4) if self.latencia is not None else None,
+                'disponible': self.disponible()}
+
+
+_lock = threading.Lock()
+_salidas = []
+_user_agents = list(USER_AGENTS)
+_siguiente_ua = [0]
+
+
+def _latencia_referencia():
+    # las salidas sin medidas compiten con la media de las demas, asi se prueban pronto
+    medidas = [salida.latencia for salida in _salidas if salida.latencia is not None]
+    return sum(medidas) / len(medidas) if medidas else 1.0
+
+
+def configurar(proxies=None, user_agents=None):
+    """(Re)crea el pool de salidas: una por proxy, o una directa si no hay proxies"""
+    proxies = PROXIES if proxies is None else proxies
+    with _lock:
+        _salidas[:] = [Salida(proxy) for proxy in proxies or [None]]
+        _user_agents[:] = user_agents or USER_AGENTS
+    return list(_salidas)
+
+
+def user_agent():
+    """Siguiente user agent de la rotacion, independiente de la salida (sin proxies tambien rota)"""
+    with _lock:
+        _siguiente_ua[0] = (_siguiente_ua[0] + 1) % len(_user_agents)
+        return _user_agents[_siguiente_ua[0]]
+
+
+def elegir():
+    """Salida para la proxima peticion: la mejor de dos al azar entre las disponibles"""
+    if not _salidas:
+        configurar()
+    ahora = time.time()
+    disponibles = [salida for salida in _salidas if salida.disponible(ahora)]
+    if not disponibles:
+        # todas fuera: se usa la que antes vuelve antes que dejar de buscar
+        return min(_salidas, key=lambda salida: salida.fuera_hasta)
+    if len(disponibles) == 1:
+        return disponibles[0]
+    return min(random.sample(disponibles, 2), key=lambda salida: salida.puntuacion())
+
+
+@contextmanager
+def medir_salida(salida):
+    """Registra en `salida` la duracion del bloque, y un error si lanza una excepcion"""
+    if salida is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        salida.registrar(False, time.perf_counter() - inicio)
+        raise
+    salida.registrar(True, time.perf_counter() - inicio)
+
+
+def get(url, **kwargs):
+    """requests.get por una salida del pool; 429 y 5xx cuentan como error de la salida"""
+    salida = elegir()
+    kwargs.setdefault('timeout', (TIMEOUT_CONEXION, TIMEOUT_CARGA))
+    kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'User-Agent': user_agent()})
+    inicio = time.perf_counter()
+    try:
+        respuesta = salida.sesion.get(url, **kwargs)
+    except requests.RequestException:
+        salida.registrar(False, time.perf_counter() - inicio)
+        raise
+    salida.registrar(respuesta.status_code != 429 and respuesta.status_code < 500, time.perf_counter() - inicio)
+    return respuesta
+
+
+def estado():
+    return [salida.estado() for salida in _salidas]